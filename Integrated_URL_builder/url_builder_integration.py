@@ -5,11 +5,37 @@ from datetime import datetime
 from google.cloud import bigquery
 from google.oauth2 import service_account
 
-from urlbuilder import URLBuilder as ScieloURLBuilder
-from urlbuilder import ScieloSearchLocations
-
 import centaurminer as mining
 import os
+import importlib
+from importlib.metadata import entry_points
+
+# Other packages add journals with entry points in this group, named after the journal,
+# e.g. entry_points={"data_pipeline.url_builders": ["example = example_urls:example_url"]}
+ENTRY_POINT_GROUP = "data_pipeline.url_builders"
+
+# URL_builder subclasses by journal name (see `register`): a class, or a "module:Class" string until first used
+_journals = {}
+_entry_points_loaded = False
+
+def register(journal_name):
+  '''
+    Class decorator adding a URL_builder subclass to the journals `URL_builder.urlbuilderfactory` knows.
+  '''
+  def decorator(cls):
+    _journals[journal_name] = cls
+    return cls
+  return decorator
+
+def _load_entry_points():
+  global _entry_points_loaded
+  if _entry_points_loaded:
+    return
+  _entry_points_loaded = True
+  found = entry_points()
+  found = found.select(group=ENTRY_POINT_GROUP) if hasattr(found, "select") else found.get(ENTRY_POINT_GROUP, ())
+  for entry_point in found:
+    _journals.setdefault(entry_point.name, entry_point.value)
 
 class URL_builder():
   """
@@ -104,15 +130,13 @@ class URL_builder():
         Example:
             URL_builder.urlbuilderfactory('arxiv','virus',1000,10)
     '''
-    journaldictionary={'arxiv':arxiv_url(search_word,limit,time_frame),
-                       'preprint':preprint_url(search_word,limit,time_frame),
-                       'biorxiv':biorxiv_url(search_word,limit,time_frame),
-                       'medrxiv':medrxiv_url(search_word,limit,time_frame),
-                       'pbmc':pbmc_url(search_word,limit,time_frame),
-                       'scielo':scielo_url(search_word,limit,time_frame),
-                       'jamanetwork': jamanetwork_url(search_word,limit,time_frame)
-                       }
-    return journaldictionary[journal_name]
+    if journal_name not in _journals:
+      _load_entry_points()
+    builder = _journals[journal_name]
+    if isinstance(builder, str):
+      module, _, name = builder.partition(":")
+      builder = _journals[journal_name] = getattr(importlib.import_module(module), name)
+    return builder(search_word,limit,time_frame)
 
   
 
@@ -209,6 +233,7 @@ class URL_builder():
 
 
 
+@register('arxiv')
 class arxiv_url(URL_builder):
   """
       Child class for getting URLs from arxiv journal.
@@ -268,6 +293,7 @@ class arxiv_url(URL_builder):
 
 
 
+@register('preprint')
 class preprint_url(URL_builder):
   """
       Child class for getting URLs from preprint journal.
@@ -289,6 +315,7 @@ class preprint_url(URL_builder):
 
 
 
+@register('biorxiv')
 class biorxiv_url(URL_builder):
   """
       Child class for getting URLs from preprint journal.
@@ -309,6 +336,7 @@ class biorxiv_url(URL_builder):
   
 
 
+@register('medrxiv')
 class medrxiv_url(URL_builder):
   """
       Child class for getting URLs from preprint journal.
@@ -327,6 +355,7 @@ class medrxiv_url(URL_builder):
       self.journal='medrxiv'  
 
 
+@register('jamanetwork')
 class jamanetwork_url(URL_builder):
   """
       Child class for getting URLs from preprint journal.
@@ -345,6 +374,7 @@ class jamanetwork_url(URL_builder):
       self.journal = 'jamanetwork'
   
 
+@register('pbmc')
 class pbmc_url(URL_builder):
   """
       Child class for getting URLs from preprint journal.
@@ -381,6 +411,7 @@ class pbmc_url(URL_builder):
     self._send_to_bigquery()
     print('\n Total no. of URLS sent to BigQuery:'+str(len(self.total_urls))) 
 
+@register('scielo')
 class scielo_url(URL_builder):
   """
       Child class for getting URLs from preprint journal.
@@ -403,6 +434,9 @@ class scielo_url(URL_builder):
 
       Returns: url_schema
     '''
+    from urlbuilder import URLBuilder as ScieloURLBuilder
+    from urlbuilder import ScieloSearchLocations
+
     print('scielo')
     miner = mining.MiningEngine(ScieloSearchLocations, driver_path=self._driver_path)
     ScieloURLBuilder.connect_to_gbq(self.credentials, self.project_id, self.table_id, self._schema)
@@ -16,6 +16,9 @@ gcloud pubsub subscriptions create $SUBSCRIBER_ID   \
      --dead-letter-topic=$DEAD_LETTER_TOPIC_ID      \
      --dead-letter-topic-project=$PROJECT_ID        \
      --ack-deadline=60                              \
+     --max-delivery-attempts=5                      \
+     --min-retry-backoff=10s                        \
+     --max-retry-backoff=600s                       \
      --expiration-period=never
 
 # Create, tag and push Docker images
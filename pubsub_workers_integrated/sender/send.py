@@ -26,8 +26,14 @@ app.config['PROJECT'] = os.environ['GOOGLE_CLOUD_PROJECT']
 MESSAGES = []
 
 # Initialize the publisher client once to avoid memory leak
-# and reduce publish latency.
-publisher = pubsub_v1.PublisherClient()
+# and reduce publish latency. Messages are sent in batches of up to
+# 1000, each batch leaving at the latest 50ms after its first message.
+batch_settings = pubsub_v1.types.BatchSettings(
+    max_messages=1000,
+    max_bytes=1024 * 1024,
+    max_latency=0.05,
+)
+publisher = pubsub_v1.PublisherClient(batch_settings)
 
 
 # [START gae_flex_pubsub_index]
@@ -90,8 +96,9 @@ if __name__ == '__main__':
     import sys
     import json
     import time
-    from datetime import datetime
-    from tables import StatusTable
+    from datetime import datetime, timedelta
+    from tables import StatusTable, CurrentStatusTable
+    from tables.ledger import UrlLedger
     #import time
     #from datetime import datetime
     #from os import environ
@@ -104,6 +111,10 @@ if __name__ == '__main__':
     #host_ip = environ.get('RABBIT_HOST_IP')
     #
     DELAY = int(os.getenv('DELAY', '60'))
+    # Only look at status rows newer than the last loop's, but read the whole table every FULL_SCAN_EVERY
+    # loops, for rows that arrived later than WATERMARK_LAG_MINUTES (or the current table's compaction lag)
+    # after their timestamp
+    FULL_SCAN_EVERY = int(os.getenv('FULL_SCAN_EVERY', '60'))
     #
     #assert None not in [mq_user, mq_pass, host_ip], "Include a .env file using the docker argument --env-file when running."
     #
@@ -116,43 +127,137 @@ if __name__ == '__main__':
     #channel.queue_declare(queue='task_queue', durable=True)
     #
     statusTable = StatusTable().GetOrCreate()
+    statusTable.watermark_lag = timedelta(minutes=int(os.getenv('WATERMARK_LAG_MINUTES', '10')))
+    # Optionally ignore urls queued more than LOOKBACK_DAYS ago, to bound the full scans
+    lookback_days = int(os.getenv('LOOKBACK_DAYS', '0'))
+    if lookback_days > 0:
+        statusTable.lookback = timedelta(days=lookback_days)
+    statusWriter = statusTable.batch_writer()
+    loops = 0
+    topic_path = publisher.topic_path(
+        os.environ['GOOGLE_CLOUD_PROJECT'],
+        os.environ['PUBSUB_TOPIC'])
+    # With a CURRENT_STATUS_TABLE_ID, the status log is compacted into a table with one row per url,
+    # which is read instead of the log
+    currentTable = None
+    if os.getenv('CURRENT_STATUS_TABLE_ID'):
+        currentTable = CurrentStatusTable().GetOrCreate()
+    # Urls published in the last LEDGER_TTL_HOURS, which aren't published again even if they still
+    # look 'Not Mined' (their 'Sent to queue' row may not be visible yet, or failed to be written)
+    ledger = UrlLedger(os.getenv('LEDGER_PATH', 'dispatched.sqlite'),
+                       ttl=float(os.getenv('LEDGER_TTL_HOURS', '6')) * 3600)
+    # Urls left 'Started Mining' for more than REAP_AFTER_MINUTES (by a worker that died) are sent again every
+    # REAP_EVERY_MINUTES, up to REAP_MAX_ATTEMPTS times, then marked 'Failed - Stuck'. Keep it above the workers'
+    # MAX_LEASE_SECONDS, so urls still being mined aren't taken for stuck
+    REAP_AFTER = timedelta(minutes=int(os.getenv('REAP_AFTER_MINUTES', '120')))
+    REAP_EVERY = int(os.getenv('REAP_EVERY_MINUTES', '30')) * 60
+    REAP_MAX_ATTEMPTS = int(os.getenv('REAP_MAX_ATTEMPTS', '3'))
+    last_reap = None
     #
-    ## Start the listening loop
-    try:
-        while True:  # Use sigint to break the loop
-            newData = statusTable.GetNewURLs()
+
+    def dispatch(rows, reaped=False):
+        '''
+        Publishes the rows to pubsub in batches, and marks the published ones 'Sent to queue'.
+
+        Rows whose url is in the ledger are skipped, unless they're reaped: those are known to be stuck. Reaped
+        rows get their reap count in meta_info, and rows reaped REAP_MAX_ATTEMPTS times already are marked
+        'Failed - Stuck' instead of being sent again.
+        '''
+        published = []
+        pending = []
+        oldest = None
+        skipped = 0
+        stuck = 0
     #
-            for row in newData:
-                # Remove extra data that doesn't need to be sent
-                row.pop('timestamp')
-                row.pop('status')
+        for row in rows:
+            # Remove extra data that doesn't need to be sent
+            timestamp = row.pop('timestamp')
+            row.pop('status')
+            if oldest is None:
+                oldest = timestamp  # Rows are sorted oldest first
+            if reaped:
+                try:
+                    meta_info = json.loads(row.get('meta_info') or '{}')
+                except ValueError:
+                    meta_info = {}
+                meta_info['reaped'] = meta_info.get('reaped', 0) + 1
+                row['meta_info'] = json.dumps(meta_info)
+                if meta_info['reaped'] > REAP_MAX_ATTEMPTS:
+                    row['timestamp'] = datetime.utcnow()
+                    row['status'] = "Failed - Stuck"
+                    pending.append(statusWriter.add(row))
+                    stuck += 1
+                    continue
+            elif row['article_url'] in ledger:
+                skipped += 1
+                continue
     #
-                request = json.dumps(row)
+            request = json.dumps(row)
     #
-                # Send the data through to the rabbitMQ queue
-                topic_path = publisher.topic_path(
-                    os.environ['GOOGLE_CLOUD_PROJECT'],
-                    os.environ['PUBSUB_TOPIC'])
-
-                print("Publishing", flush=True)
-                publisher.publish(topic_path, data=request.encode("utf-8"))
-    #            channel.basic_publish(
-    #                exchange='',
-    #                routing_key='task_queue',
-    #                body=request,
-    #                properties=pika.BasicProperties(
-    #                    delivery_mode=2,  # make message persistent
-    #                ))
-                print(f" [x] Sent {request}", flush=True)
+            # Queue the data for the next pubsub batch
+            published.append((row, publisher.publish(topic_path, data=request.encode("utf-8"))))
+    #        channel.basic_publish(
+    #            exchange='',
+    #            routing_key='task_queue',
+    #            body=request,
+    #            properties=pika.BasicProperties(
+    #                delivery_mode=2,  # make message persistent
+    #            ))
     #
-                # Update the input row with a new timestamp and status, and add a row to the bq table
-                row['timestamp'] = datetime.utcnow()
-                row['status'] = "Sent to queue"
-                #errors = bq_client.insert_rows(
-                errors = statusTable.insert_row(row)
-                if errors != []:
-                    print(f"We've got some errors when updating bq: {errors}", flush=True)
-            print(f"Sent {len(newData)} rows to pubsub queue.", flush=True)
+        # Only the rows that made it to the queue are marked as sent, the others stay as they were
+        publish_errors = []
+        sent = []
+        for row, future in published:
+            try:
+                future.result()
+            except Exception as e:
+                publish_errors.append(e)
+                continue
+            sent.append(row['article_url'])
+            # Update the input row with a new timestamp and status, and add a row to the bq table
+            row['timestamp'] = datetime.utcnow()
+            row['status'] = "Sent to queue"
+            #errors = bq_client.insert_rows(
+            pending.append(statusWriter.add(row))
+        ledger.add_many(sent)
+        # Make sure the statuses are in bq before the next GetNewURLs
+        statusWriter.flush()
+        errors = [error for future in pending for error in future.result()]
+        if publish_errors != []:
+            print(f"Failed to publish {len(publish_errors)} rows, first error: {publish_errors[0]}", flush=True)
+        if errors != []:
+            print(f"We've got some errors when updating bq: {errors}", flush=True)
+        if (publish_errors != [] or errors != []) and not reaped:
+            # Some urls may still be 'Not Mined' - make sure the next query sees them again
+            statusTable.RewindWatermark(oldest)
+        if reaped:
+            print(f"Sent {len(sent)} stuck rows to pubsub queue again, gave up on {stuck}.", flush=True)
+        else:
+            print(f"Sent {len(sent)} rows to pubsub queue.", flush=True)
+        if skipped:
+            print(f"Skipped {skipped} rows already sent in the last {ledger.ttl / 3600:g} hours.", flush=True)
+    #
+    ## Start the listening loop
+    try:
+        while True:  # Use sigint to break the loop
+            full_scan = FULL_SCAN_EVERY > 0 and loops % FULL_SCAN_EVERY == 0
+            if currentTable is not None:
+                currentTable.Compact(statusTable, full=full_scan)
+                newData = currentTable.GetNewURLs()
+            else:
+                newData = statusTable.GetNewURLs(incremental=not full_scan)
+            loops += 1
+            ledger.purge()
+            dispatch(newData)
+
+            if last_reap is None or time.monotonic() - last_reap >= REAP_EVERY:
+                last_reap = time.monotonic()
+                reaper = currentTable if currentTable is not None else statusTable
+                dispatch(reaper.GetStuckURLs(REAP_AFTER), reaped=True)
+
+            if currentTable is not None:
+                counts = currentTable.StatusCounts()
+                print("Urls by status: " + ", ".join(f"{status} {count}" for status, count in sorted(counts.items())), flush=True)
     #
             # Wait for the next loop
             time.sleep(DELAY)
@@ -160,4 +265,7 @@ if __name__ == '__main__':
         print("ctrl+c caught - exiting", flush=True)
     except Exception as e:
         raise e
+    finally:
+        statusWriter.close()
+        ledger.close()
     #connection.close()
@@ -1,3 +1,10 @@
+import os
+import json
+import time
+import tempfile
+import threading
+from concurrent.futures import Future
+from datetime import datetime, timedelta
 from os import environ
 from google.cloud import bigquery
 from google.cloud.exceptions import NotFound
@@ -5,15 +12,30 @@ from google.cloud.exceptions import NotFound
 class BQTable:
     table_id = None
     schema = None
+    # Column the table is partitioned by (by day), and columns it's clustered by, when it's created
+    partition_field = None
+    clustering_fields = None
+    # json file where the tables' metadata is kept between runs, so they aren't looked up again. Unset: no cache
+    cache_path = environ.get("TABLE_CACHE_PATH") or None
     def __init__(self):
         self._table = None
-        self._client = None
+        self._bq_client = None
+
+    @property
+    def _client(self):
+        '''
+        The bigquery client, only created when it's first used.
+        '''
+        if self._bq_client is None:
+            self._bq_client = bigquery.Client(self.table_id.split(".")[0])
+        return self._bq_client
 
     def GetOrCreate(self, project_id = None, dataset_id = None, table_name = None):
         '''
         Gets a table from bigquery, or creates it if necessary. Returns a reference to that table.
 
-        Updates self.table_id if any arguments are supplied.
+        Updates self.table_id if any arguments are supplied. If the table's metadata is in the file at
+        cache_path, it's used as is, without asking bigquery (nor creating a client) at all.
         '''
         table_id = self.table_id.split(".")
         
@@ -31,40 +53,92 @@ class BQTable:
         project_id, dataset_id, table_name = table_id
         self.table_id = ".".join(table_id)
 
-        self._client = bigquery.Client(project_id)
-
-        # Check to see if the dataset already exists, or if it should be created
-        _dataset = None
-        for bq_dataset in self._client.list_datasets():
-            if bq_dataset.dataset_id == dataset_id:
-                _dataset = self._client.get_dataset(bq_dataset.reference)
-                break
+        self._table = self._Cached()
+        if self._table is not None:
+            return self
 
-        if _dataset is None:  # Dataset not found
+        try:
+            self._table = self._client.get_table(self.table_id)
+            self._CheckLayout()
+        except NotFound: # Table not found, and maybe not its dataset either
             _dataset = bigquery.Dataset(f"{project_id}.{dataset_id}")
             _dataset.location = "US" # Not sure if this is necessary
-            self._client.create_dataset(_dataset, timeout=30)
-            print(f"Created dataset {self._client.project}.{_dataset.dataset_id}")
-
-        # Check if this table exists, or if it should be created
-        self._table = None
-        for bq_table in self._client.list_tables(_dataset):
-            if bq_table.table_id == table_name:
-                self._table = self._client.get_table(bq_table.reference)
-
-        if self._table is None: # Table not found
-            _table = bigquery.Table(self.table_id, schema = self.schema)
-            self._table = self._client.create_table(_table, timeout=30)
+            self._client.create_dataset(_dataset, exists_ok = True, timeout = 30)
+            self._table = self._client.create_table(self._Definition(), exists_ok = True, timeout = 30)
             print(f"Created table {self.table_id}", flush=True)
 
+        self._Cache()
         return self
 
-    def Query(self, query):
+    def _Cached(self):
+        '''
+        Returns the table from the cache file, or None if it isn't there, or has another schema than self.schema.
+        '''
+        if self.cache_path is None:
+            return None
+        try:
+            with open(self.cache_path) as f:
+                _table = bigquery.Table.from_api_repr(json.load(f)[self.table_id])
+        except (OSError, ValueError, KeyError):
+            return None
+        if [field.name for field in _table.schema] != [field.name for field in self.schema]:
+            return None
+        return _table
+
+    def _Cache(self):
+        '''
+        Saves the table's metadata in the cache file, next to the other tables' there.
+        '''
+        if self.cache_path is None:
+            return
+        try:
+            with open(self.cache_path) as f:
+                cached = json.load(f)
+        except (OSError, ValueError):
+            cached = {}
+        cached[self.table_id] = self._table.to_api_repr()
+        try:
+            # Written aside and renamed, as other workers on the node may share the file
+            fd, tmp_path = tempfile.mkstemp(dir = os.path.dirname(os.path.abspath(self.cache_path)))
+            with os.fdopen(fd, "w") as f:
+                json.dump(cached, f)
+            os.replace(tmp_path, self.cache_path)
+        except OSError as e:
+            print(f"Couldn't cache the metadata of {self.table_id}: {e!r}", flush=True)
+
+    def _Definition(self):
+        '''
+        Returns the bigquery.Table to create, with its schema, partitioning and clustering.
+        '''
+        _table = bigquery.Table(self.table_id, schema = self.schema)
+        if self.partition_field is not None:
+            _table.time_partitioning = bigquery.TimePartitioning(
+                type_ = bigquery.TimePartitioningType.DAY,
+                field = self.partition_field)
+        if self.clustering_fields is not None:
+            _table.clustering_fields = self.clustering_fields
+        return _table
+
+    def _CheckLayout(self):
+        '''
+        Warns if an existing table isn't partitioned/clustered like new ones are. Existing tables aren't altered.
+        '''
+        partitioning = self._table.time_partitioning
+        if self.partition_field is not None and (partitioning is None or partitioning.field != self.partition_field):
+            print(f"Table {self.table_id} isn't partitioned by {self.partition_field}; "
+                  "recreate it to get partitioned queries.", flush=True)
+        elif self.clustering_fields is not None and self._table.clustering_fields != self.clustering_fields:
+            print(f"Table {self.table_id} isn't clustered by {', '.join(self.clustering_fields)}.", flush=True)
+
+    def Query(self, query, params = None):
         '''
         Queries the table using the given query, returning a list-of-dicts representation of the data.
+
+        params is an optional list of bigquery.ScalarQueryParameter, for the @names in the query.
         '''
         #client = bigquery.Client(self.table_id.split(".")[0])
-        query_job = self._client.query(query)
+        job_config = bigquery.QueryJobConfig(query_parameters = params or [])
+        query_job = self._client.query(query, job_config = job_config)
         rows = query_job.result()
         json_rows = [ dict(row) for row in rows ]
         #json_rows = []
@@ -86,9 +160,149 @@ class BQTable:
             rows = rows
         )
 
+    def batch_writer(self, **kwargs):
+        '''
+        Returns a BatchWriter that buffers rows for this table. See BatchWriter for the arguments.
+        '''
+        return BatchWriter(self, **kwargs)
+
+
+class BatchWriter:
+    '''
+    Buffers rows for a BQTable and streams them to bigquery in batches, from a background thread.
+
+    A batch is sent when `max_rows` rows or `max_bytes` bytes are buffered, or when the oldest
+    buffered row is `max_age` seconds old. Rows that bigquery rejects are retried on their own
+    (not the whole batch), up to `max_retries` times. Rows reported as invalid aren't retried.
+
+    add() returns a concurrent.futures.Future for the row, which resolves to the list of errors
+    for that row once it's been sent - an empty list means the row is stored in bigquery.
+    '''
+    def __init__(self, table, max_rows = 500, max_bytes = 5_000_000, max_age = 5, max_retries = 3):
+        self.table = table
+        self.max_rows = max_rows
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.max_retries = max_retries
+
+        self._rows = []
+        self._bytes = 0
+        self._oldest = None
+        self._closed = False
+        self._cond = threading.Condition()
+        self._thread = threading.Thread(target = self._run, name = f"BatchWriter({table.table_id})", daemon = True)
+        self._thread.start()
+
+    def add(self, row):
+        '''
+        Queues a copy of the row for insertion, and returns a Future with its errors.
+        '''
+        future = Future()
+        size = len(json.dumps(row, default = str))
+        with self._cond:
+            if self._closed:
+                raise RuntimeError("BatchWriter is closed")
+            self._rows.append((dict(row), future))
+            self._bytes += size
+            if self._oldest is None:  # Wakes the thread up to start the max_age timer
+                self._oldest = time.monotonic()
+                self._cond.notify()
+            elif self._full():
+                self._cond.notify()
+        return future
+
+    def flush(self):
+        '''
+        Sends every buffered row now, and waits until they're written (or given up on).
+        '''
+        with self._cond:
+            batch = self._take()
+        self._send(batch)
+
+    def close(self):
+        '''
+        Flushes the remaining rows and stops the background thread.
+        '''
+        with self._cond:
+            self._closed = True
+            self._cond.notify()
+        self._thread.join()
+
+    def _full(self):
+        return len(self._rows) >= self.max_rows or self._bytes >= self.max_bytes
+
+    def _take(self):
+        batch = self._rows
+        self._rows = []
+        self._bytes = 0
+        self._oldest = None
+        return batch
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._closed and not self._full():
+                    if self._oldest is None:
+                        self._cond.wait()
+                        continue
+                    timeout = self._oldest + self.max_age - time.monotonic()
+                    if timeout <= 0:
+                        break
+                    self._cond.wait(timeout)
+                batch = self._take()
+                closed = self._closed
+            self._send(batch)
+            if closed:
+                return
+
+    def _send(self, batch):
+        for attempt in range(self.max_retries + 1):
+            if not batch:
+                return
+            try:
+                errors = self.table.insert_rows([row for row, _ in batch])
+            except Exception as e:  # The whole request failed, so every row did
+                errors = [{'index': i, 'errors': [{'reason': 'request', 'message': str(e)}]} for i in range(len(batch))]
+            failed = {error['index']: error['errors'] for error in errors}
+
+            retry = []
+            for i, (row, future) in enumerate(batch):
+                if i not in failed:
+                    future.set_result([])
+                elif attempt == self.max_retries or all(e.get('reason') == 'invalid' for e in failed[i]):
+                    future.set_result(failed[i])
+                else:
+                    retry.append((row, future))
+            batch = retry
+            if batch:
+                time.sleep(min(2 ** attempt, 30))
+
+
+def on_flushed(futures, callback):
+    '''
+    Calls callback(errors) once every BatchWriter future is done, with all of their errors in one list.
+    '''
+    futures = list(futures)
+    remaining = [len(futures)]
+    lock = threading.Lock()
+
+    def done(_):
+        with lock:
+            remaining[0] -= 1
+            if remaining[0]:
+                return
+        callback([error for future in futures for error in future.result()])
+
+    if not futures:
+        callback([])
+    for future in futures:
+        future.add_done_callback(done)
+
 class StatusTable(BQTable):
     # TODO: change DATETIME to TIMESTAMP
     table_id = environ.get("STATUS_TABLE_ID")
+    partition_field = "timestamp"
+    clustering_fields = ["article_url", "status"]
     schema = [
         bigquery.SchemaField("article_url", "STRING",   mode = "REQUIRED"),
         bigquery.SchemaField("catalog_url", "STRING",   mode = "REQUIRED"),
@@ -100,23 +314,231 @@ class StatusTable(BQTable):
         bigquery.SchemaField("meta_info",   "STRING"                     )
     ]
 
-    def GetNewURLs(self):
+    # How far behind the last query the watermark is kept, for rows streamed with a late timestamp
+    watermark_lag = timedelta(minutes = 10)
+    # If set, urls whose 'Not Mined' row is older than this are never looked at, so full scans only read recent partitions
+    lookback = None
+    max_new_urls = 100000
+
+    def __init__(self):
+        super().__init__()
+        self._watermark = None
+        self._signature = None
+
+    def GetNewURLs(self, incremental = False):
+        '''
+        Returns the rows of the urls whose latest status is 'Not Mined' (oldest first, at most max_new_urls).
+
+        With incremental=True, only rows newer than a watermark are looked at, so the query doesn't grow
+        with the table: a url's 'Not Mined' row is always older than the statuses that follow it, so those
+        are in the window too. The watermark starts unset (the first call reads the whole table) and moves
+        up to watermark_lag before each query (full ones too). If the table hasn't changed since a query
+        that returned everything, the incremental query is skipped and nothing is returned.
+        '''
+        signature = self._Signature()
+        if incremental and signature is not None and signature == self._signature:
+            return []
+        started = datetime.utcnow()
+
+        # Filtering on timestamp, the partitioning column, limits the partitions the query reads
+        since = None
+        if incremental and self._watermark is not None:
+            since = self._watermark
+        if self.lookback is not None and (since is None or since < started - self.lookback):
+            since = started - self.lookback
+        where, params = "", []
+        if since is not None:
+            where = "WHERE timestamp > @since"
+            params = [bigquery.ScalarQueryParameter("since", "DATETIME", since)]
         QUERY = """
             SELECT """ + ",".join(col.name for col in self.schema) + """
                 FROM (
                     SELECT *, ROW_NUMBER() OVER
                     (PARTITION BY article_url ORDER BY timestamp DESC) AS rn
                     FROM `""" + self.table_id + """`
+                    """ + where + """
                     )
             WHERE rn = 1 AND status='Not Mined' AND is_pdf = 0
             ORDER BY timestamp ASC
-            LIMIT 100000;
+            LIMIT """ + str(self.max_new_urls) + """;
+        """
+        rows = self.Query(QUERY, params)
+
+        if len(rows) < self.max_new_urls:
+            watermark = started - self.watermark_lag
+            self._signature = signature
+        else:  # There's more after the last row - start from it next time
+            watermark = rows[-1]['timestamp'] - self.watermark_lag
+            self._signature = None
+        if self._watermark is None or watermark > self._watermark:
+            self._watermark = watermark
+        return rows
+
+    def GetStuckURLs(self, lease):
+        '''
+        Returns the rows of the urls whose latest status is 'Started Mining', and older than lease (a timedelta).
+
+        'Sent to queue' urls aren't stuck: their message is still in the subscription, however long it's been waiting.
+
+        Only the rows since the lookback (if any) are looked at.
+        '''
+        stale_before = datetime.utcnow() - lease
+        where = ""
+        params = [bigquery.ScalarQueryParameter("stale_before", "DATETIME", stale_before)]
+        if self.lookback is not None:
+            where = "WHERE timestamp > @since"
+            params.append(bigquery.ScalarQueryParameter("since", "DATETIME", datetime.utcnow() - self.lookback))
+        QUERY = """
+            SELECT """ + ",".join(col.name for col in self.schema) + """
+                FROM (
+                    SELECT *, ROW_NUMBER() OVER
+                    (PARTITION BY article_url ORDER BY timestamp DESC) AS rn
+                    FROM `""" + self.table_id + """`
+                    """ + where + """
+                    )
+            WHERE rn = 1 AND status = 'Started Mining' AND timestamp < @stale_before
+            ORDER BY timestamp ASC
+            LIMIT """ + str(self.max_new_urls) + """;
+        """
+        return self.Query(QUERY, params)
+
+    def IsFinished(self, article_url):
+        '''
+        Tells if the article was mined and stored already, i.e. if it ever got a 'Finished Mining' status (partial or not).
+        '''
+        QUERY = """
+            SELECT 1
+                FROM `""" + self.table_id + """`
+            WHERE article_url = @article_url AND status IN ('Finished Mining', 'Finished Mining - Partial')
+            LIMIT 1;
+        """
+        params = [bigquery.ScalarQueryParameter("article_url", "STRING", article_url)]
+        return len(self.Query(QUERY, params)) > 0
+
+    def RewindWatermark(self, timestamp):
+        '''
+        Makes the next incremental GetNewURLs look at rows from timestamp on again.
+
+        Used when the urls returned by a GetNewURLs couldn't all be marked as sent.
+        '''
+        self._signature = None
+        if self._watermark is not None:
+            self._watermark = min(self._watermark, timestamp - self.watermark_lag)
+
+    def _Signature(self):
+        '''
+        Returns something that changes whenever rows are added to the table, or None if it can't tell.
+        '''
+        try:
+            table = self._client.get_table(self.table_id)
+        except Exception:
+            return None
+        buffer = table.streaming_buffer
+        if buffer is None:
+            return (table.modified, table.num_rows)
+        return (table.modified, table.num_rows, buffer.estimated_rows, buffer.oldest_entry_time)
+
+
+class CurrentStatusTable(BQTable):
+    '''
+    The latest row of each article_url in the status table, kept up to date with Compact().
+
+    The status table is a log with a row per status change. Reading the current state of the urls from
+    this table instead doesn't need a window function over the whole log.
+    '''
+    table_id = environ.get("CURRENT_STATUS_TABLE_ID")
+    clustering_fields = ["status", "article_url"]
+    schema = StatusTable.schema
+    compaction_lag = timedelta(minutes = 10)
+    max_new_urls = StatusTable.max_new_urls
+
+    def __init__(self):
+        super().__init__()
+        self._compacted = None
+        self._signature = None
+
+    def Compact(self, status_table, full = False):
+        '''
+        Merges the status table rows added since the last compaction (less compaction_lag, for late rows)
+        into this table. The first compaction reads the whole status table, and so does a full one, for
+        rows inserted later than compaction_lag after their timestamp. Unless full, does nothing if the
+        status table hasn't changed since the last compaction.
+        '''
+        signature = status_table._Signature()
+        if not full and signature is not None and signature == self._signature:
+            return
+        started = datetime.utcnow()
+
+        where, params = "", []
+        if self._compacted is not None and not full:
+            where = "WHERE timestamp > @since"
+            params = [bigquery.ScalarQueryParameter("since", "DATETIME", self._compacted - self.compaction_lag)]
+        columns = [col.name for col in self.schema]
+        QUERY = """
+            MERGE `""" + self.table_id + """` T
+            USING (
+                SELECT """ + ",".join(columns) + """
+                    FROM (
+                        SELECT *, ROW_NUMBER() OVER
+                        (PARTITION BY article_url ORDER BY timestamp DESC) AS rn
+                        FROM `""" + status_table.table_id + """`
+                        """ + where + """
+                        )
+                WHERE rn = 1
+                ) S
+            ON T.article_url = S.article_url
+            WHEN MATCHED AND S.timestamp >= T.timestamp THEN
+                UPDATE SET """ + ", ".join(f"{name} = S.{name}" for name in columns if name != "article_url") + """
+            WHEN NOT MATCHED THEN
+                INSERT ROW;
+        """
+        self.Query(QUERY, params)
+        self._compacted = started
+        self._signature = signature
+
+    def GetNewURLs(self):
+        '''
+        Returns the rows of the urls whose current status is 'Not Mined' (oldest first, at most max_new_urls).
+        '''
+        QUERY = """
+            SELECT """ + ",".join(col.name for col in self.schema) + """
+                FROM `""" + self.table_id + """`
+            WHERE status='Not Mined' AND is_pdf = 0
+            ORDER BY timestamp ASC
+            LIMIT """ + str(self.max_new_urls) + """;
         """
         return self.Query(QUERY)
 
+    def GetStuckURLs(self, lease):
+        '''
+        Returns the rows of the urls whose current status is 'Started Mining', and older than lease (a timedelta). See StatusTable.GetStuckURLs.
+        '''
+        QUERY = """
+            SELECT """ + ",".join(col.name for col in self.schema) + """
+                FROM `""" + self.table_id + """`
+            WHERE status = 'Started Mining' AND timestamp < @stale_before
+            ORDER BY timestamp ASC
+            LIMIT """ + str(self.max_new_urls) + """;
+        """
+        params = [bigquery.ScalarQueryParameter("stale_before", "DATETIME", datetime.utcnow() - lease)]
+        return self.Query(QUERY, params)
+
+    def StatusCounts(self):
+        '''
+        Returns how many urls are currently in each status, as a {status: count} dict.
+        '''
+        QUERY = """
+            SELECT status, COUNT(*) AS count
+                FROM `""" + self.table_id + """`
+            GROUP BY status;
+        """
+        return {row['status']: row['count'] for row in self.Query(QUERY)}
+
 
 class DataTable(BQTable):
     table_id = environ.get("DATA_TABLE_ID")
+    partition_field = "acquisition_date"
+    clustering_fields = ["source", "doi"]
     # TODO: change DATETIME to TIMESTAMP
     schema = [
         bigquery.SchemaField("abstract",         "STRING",   mode = "REQUIRED"),
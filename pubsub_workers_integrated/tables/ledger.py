@@ -0,0 +1,67 @@
+import time
+import sqlite3
+import threading
+from urllib.parse import urlsplit, urlunsplit
+
+
+def normalize_url(url):
+    '''
+    Returns the url in the form used as a ledger key: lowercase scheme and host, no fragment.
+    '''
+    parts = urlsplit(url.strip())
+    return urlunsplit((parts.scheme.lower(), parts.netloc.lower(), parts.path, parts.query, ''))
+
+
+class UrlLedger:
+    '''
+    A small on-disk set of urls, each forgotten `ttl` seconds after it was added, kept in a sqlite file.
+
+    It remembers what this process did with urls more reliably than bigquery can tell right after the fact
+    (streamed rows take a while to show up in queries, and inserts may fail), and survives restarts.
+    '''
+    def __init__(self, path, ttl = 6 * 3600):
+        self.path = path
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread = False, isolation_level = None)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("CREATE TABLE IF NOT EXISTS urls (url TEXT PRIMARY KEY, added REAL NOT NULL)")
+        self.purge()
+
+    def __contains__(self, url):
+        with self._lock:
+            row = self._db.execute("SELECT added FROM urls WHERE url = ?", (normalize_url(url),)).fetchone()
+        return row is not None and row[0] > time.time() - self.ttl
+
+    def add(self, url):
+        self.add_many([url])
+
+    def add_many(self, urls):
+        '''
+        Adds urls to the ledger (or refreshes them), in one transaction.
+        '''
+        now = time.time()
+        with self._lock:
+            self._db.execute("BEGIN")
+            try:
+                self._db.executemany("INSERT OR REPLACE INTO urls (url, added) VALUES (?, ?)",
+                                     [(normalize_url(url), now) for url in urls])
+            except BaseException:
+                self._db.execute("ROLLBACK")  # Or every later add would fail on the open transaction
+                raise
+            self._db.execute("COMMIT")
+
+    def discard(self, url):
+        with self._lock:
+            self._db.execute("DELETE FROM urls WHERE url = ?", (normalize_url(url),))
+
+    def purge(self):
+        '''
+        Deletes the urls older than the ttl.
+        '''
+        with self._lock:
+            self._db.execute("DELETE FROM urls WHERE added <= ?", (time.time() - self.ttl,))
+
+    def close(self):
+        with self._lock:
+            self._db.close()
@@ -0,0 +1,47 @@
+import os
+import sys
+import threading
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from tables import BatchWriter
+
+
+class StubTable:
+    table_id = "project.dataset.stub"
+
+    def __init__(self):
+        self.inserted = []
+        self.inserts = threading.Event()
+
+    def insert_rows(self, rows):
+        self.inserted.append(list(rows))
+        self.inserts.set()
+        return []
+
+
+class BatchWriterTest(unittest.TestCase):
+    def test_rows_flush_by_age(self):
+        table = StubTable()
+        writer = BatchWriter(table, max_age = 0.2)
+        try:
+            future = writer.add({"article_url": "https://example.org/1"})
+            self.assertEqual(future.result(timeout = 3), [])
+            self.assertEqual(table.inserted, [[{"article_url": "https://example.org/1"}]])
+        finally:
+            writer.close()
+
+    def test_rows_flush_by_count(self):
+        table = StubTable()
+        writer = BatchWriter(table, max_rows = 2, max_age = 60)
+        try:
+            futures = [writer.add({"n": n}) for n in range(2)]
+            self.assertEqual([future.result(timeout = 3) for future in futures], [[], []])
+            self.assertEqual(len(table.inserted), 1)
+        finally:
+            writer.close()
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,100 @@
+import os
+import sys
+import unittest
+from unittest import mock
+
+import centaurminer as mining
+import requests
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "worker"))
+
+from miners import engine
+from miners.engine import BaseEngine
+
+PAGE = b"""<html>
+<head>
+    <meta name="citation_title" content="Mining without a browser">
+    <meta name="citation_author" content="Ada Lovelace">
+    <meta name="citation_author" content="Charles Babbage">
+    <meta property="og:type" content="article">
+</head>
+<body>
+    <h1 id="heading">  Mining   <i>without</i> a browser </h1>
+    <div class="abstract"><p>First   paragraph.</p>
+    <p>Second paragraph.</p></div>
+    <a href="/content/1.full.pdf">Full Text PDF</a>
+</body>
+</html>"""
+
+
+class Locations(mining.PageLocations):
+    title = mining.MetaData("citation_title")
+    authors = mining.MetaData("citation_author")
+    kind = mining.MetaData("og:type")
+    heading = mining.Element("id", "heading")
+    abstract = mining.Element("css_selector", "div.abstract")
+    extra_link = mining.Element("xpath", "//a[contains(., 'PDF')]").get_attribute("href")
+    abstract_html = mining.Element("class_name", "abstract").get_attribute("innerHTML")
+    missing = mining.Element("css_selector", "div.missing")
+    language = "en"
+
+
+class HttpEngine(BaseEngine):
+    use_browser = False
+
+    def get_authors(self, element):
+        return self.get(element, several=True)
+
+
+class StubSession:
+    def __init__(self, status_code=200, content=PAGE):
+        self.status_code = status_code
+        self.content = content
+
+    def get(self, url, timeout=None):
+        response = requests.Response()
+        response.status_code = self.status_code
+        response._content = self.content
+        response.url = url
+        return response
+
+
+class HttpEngineTest(unittest.TestCase):
+    def gather(self, session, fields=None):
+        miner = HttpEngine(Locations, fields=fields)
+        with mock.patch.object(engine, "http_session", return_value=session):
+            miner.gather("https://www.example.org/content/1")
+        return miner
+
+    def test_locations_are_read_like_selenium_would(self):
+        miner = self.gather(StubSession())
+        results = miner.results
+        self.assertEqual(miner.status_code, 200)
+        self.assertEqual(results["title"], "Mining without a browser")
+        self.assertEqual(results["authors"], ["Ada Lovelace", "Charles Babbage"])
+        self.assertEqual(results["kind"], "article")
+        self.assertEqual(results["heading"], "Mining without a browser")
+        self.assertEqual(results["abstract"], "First paragraph.\nSecond paragraph.")
+        self.assertEqual(results["extra_link"], "https://www.example.org/content/1.full.pdf")
+        self.assertTrue(results["abstract_html"].startswith("<p>First   paragraph.</p>"))
+        self.assertIsNone(results["missing"])
+        self.assertEqual(results["language"], "en")
+        self.assertEqual(results["url"], "https://www.example.org/content/1")
+
+    def test_only_the_given_fields_are_gathered(self):
+        miner = self.gather(StubSession(), fields={"title", "language"})
+        self.assertEqual(set(miner.results), {"title", "language", "url", "date_aquisition"})
+
+    def test_server_errors_raise(self):
+        with self.assertRaises(requests.HTTPError):
+            self.gather(StubSession(500, b"<html><body>Internal error</body></html>"))
+
+    def test_error_statuses_are_left_to_the_caller(self):
+        for status_code in (404, 429, 503):
+            miner = self.gather(StubSession(status_code, b"<html><body>Error</body></html>"))
+            self.assertEqual(miner.status_code, status_code)
+            self.assertIsNone(miner.results["title"])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,28 @@
+import os
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from tables.ledger import UrlLedger
+
+
+class UrlLedgerTest(unittest.TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.ledger = UrlLedger(os.path.join(directory.name, "ledger.sqlite"))
+        self.addCleanup(self.ledger.close)
+
+    def test_failed_add_is_rolled_back(self):
+        with self.assertRaises(AttributeError):
+            self.ledger.add_many(["https://example.com/a", None])
+        self.assertNotIn("https://example.com/a", self.ledger)
+
+        self.ledger.add("https://example.com/b")
+        self.assertIn("https://example.com/b", self.ledger)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,62 @@
+import os
+import sys
+import unittest
+import urllib.error
+import urllib.request
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "worker"))
+
+from metrics import Metrics
+
+
+class MetricsTest(unittest.TestCase):
+    def test_counters_are_rendered_by_label(self):
+        metrics = Metrics()
+        metrics.inc("messages_total", outcome="Finished Mining", domain="biorxiv.org")
+        metrics.inc("messages_total", outcome="Finished Mining", domain="biorxiv.org")
+        metrics.inc("messages_total", value=3, outcome='Failed - "quoted"\n', domain="arxiv.org")
+        self.assertEqual(metrics.render().splitlines(), [
+            "# TYPE miner_messages_total counter",
+            'miner_messages_total{domain="arxiv.org",outcome="Failed - \\"quoted\\"\\n"} 3',
+            'miner_messages_total{domain="biorxiv.org",outcome="Finished Mining"} 2',
+        ])
+
+    def test_histograms_have_cumulative_buckets(self):
+        metrics = Metrics(prefix="test")
+        for seconds in (0.004, 0.3, 0.5, 300):
+            metrics.observe("page_seconds", seconds, domain="arxiv.org")
+        lines = metrics.render().splitlines()
+        self.assertEqual(lines[0], "# TYPE test_page_seconds histogram")
+        self.assertIn('test_page_seconds_bucket{domain="arxiv.org",le="0.005"} 1', lines)
+        self.assertIn('test_page_seconds_bucket{domain="arxiv.org",le="0.25"} 1', lines)
+        self.assertIn('test_page_seconds_bucket{domain="arxiv.org",le="0.5"} 3', lines)
+        self.assertIn('test_page_seconds_bucket{domain="arxiv.org",le="250"} 3', lines)
+        self.assertIn('test_page_seconds_bucket{domain="arxiv.org",le="+Inf"} 4', lines)
+        self.assertIn('test_page_seconds_sum{domain="arxiv.org"} 300.804', lines)
+        self.assertIn('test_page_seconds_count{domain="arxiv.org"} 4', lines)
+
+    def test_summary(self):
+        metrics = Metrics()
+        for seconds in (0.2, 0.2, 0.2, 4):
+            metrics.observe("message_seconds", seconds)
+        metrics.inc("browsers_recycled_total", reason="pages")
+        self.assertEqual(metrics.summary().splitlines(), [
+            "message_seconds: n=4 mean=1.15s p50<=0.25s p95<=5s",
+            'browsers_recycled_total{reason="pages"}: 1',
+        ])
+
+    def test_serve(self):
+        metrics = Metrics()
+        metrics.inc("messages_total")
+        server = metrics.serve(0)
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        url = f"http://127.0.0.1:{server.server_address[1]}"
+        with urllib.request.urlopen(url + "/metrics") as response:
+            self.assertEqual(response.read().decode("utf-8"), metrics.render())
+        with self.assertRaises(urllib.error.HTTPError):
+            urllib.request.urlopen(url + "/other")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,56 @@
+import os
+import sys
+import types
+import unittest
+from importlib.metadata import EntryPoint
+from unittest import mock
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "worker"))
+
+import miners
+
+
+class ExampleMiner:
+    pass
+
+
+class RegistryTest(unittest.TestCase):
+    def setUp(self):
+        patcher = mock.patch.multiple(miners, _miners=dict(miners._miners), _entry_points_loaded=True)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.module = types.SimpleNamespace(ExampleMiner=ExampleMiner)
+
+    def test_module_is_imported_once_on_first_use(self):
+        miners.register("example.org", "example_miner:ExampleMiner")
+        with mock.patch.object(miners.importlib, "import_module", return_value=self.module) as import_module:
+            self.assertIn("example.org", miners.domains())
+            import_module.assert_not_called()
+            self.assertIs(miners.get("example.org"), ExampleMiner)
+            self.assertIs(miners.get("example.org"), ExampleMiner)
+        import_module.assert_called_once_with("example_miner")
+
+    def test_classes_can_be_registered(self):
+        miners.register("example.org", ExampleMiner)
+        self.assertIs(miners.get("example.org"), ExampleMiner)
+
+    def test_unknown_domain(self):
+        with self.assertRaises(KeyError):
+            miners.get("example.org")
+
+    def test_entry_points_are_registered(self):
+        found = [EntryPoint("example.org", "example_miner:ExampleMiner", miners.ENTRY_POINT_GROUP)]
+        miners._entry_points_loaded = False
+        with mock.patch.object(miners, "entry_points", return_value={miners.ENTRY_POINT_GROUP: found}), \
+                mock.patch.object(miners.importlib, "import_module", return_value=self.module):
+            self.assertIs(miners.get("example.org"), ExampleMiner)
+        self.assertIn("biorxiv.org", miners.domains())
+
+    def test_domain_of(self):
+        self.assertEqual(miners.domain_of("https://www.biorxiv.org/content/1v1"), "biorxiv.org")
+        self.assertEqual(miners.domain_of("http://scielo.sld.cu/scielo.php?pid=1"), "sld.cu")
+        self.assertIsNone(miners.domain_of("not a url", fail_silently=True))
+
+
+if __name__ == "__main__":
+    unittest.main()
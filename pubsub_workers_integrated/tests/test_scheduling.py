@@ -0,0 +1,93 @@
+import os
+import sys
+import unittest
+from unittest import mock
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "worker"))
+
+import scheduling
+from scheduling import DomainBusyError, DomainScheduler
+
+
+class FakeClock:
+    """Stands in for the time module: sleeping only moves the clock forward."""
+    def __init__(self):
+        self.now = 1000.0
+        self.sleeps = []
+
+    def monotonic(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+
+class DomainSchedulerTest(unittest.TestCase):
+    def setUp(self):
+        self.clock = FakeClock()
+        patcher = mock.patch.object(scheduling, "time", self.clock)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def request(self, scheduler, domain="example.org"):
+        """Goes through one request of the domain, and returns how long it had to wait for its turn."""
+        slept = len(self.clock.sleeps)
+        with scheduler.slot(domain):
+            pass
+        return sum(self.clock.sleeps[slept:])
+
+    def test_requests_are_paced_by_domain(self):
+        scheduler = DomainScheduler(min_delay=1, max_delay=4)
+        self.assertEqual(self.request(scheduler), 0)
+        self.assertEqual(self.request(scheduler), 1)
+        self.assertEqual(self.request(scheduler, "example.com"), 0)
+
+    def test_tokens_refill_while_idle(self):
+        scheduler = DomainScheduler(min_delay=1, max_delay=4)
+        self.request(scheduler)
+        self.clock.now += 0.75
+        self.assertAlmostEqual(self.request(scheduler), 0.25)
+        self.clock.now += 5
+        self.assertEqual(self.request(scheduler), 0)
+
+    def test_pacing_past_the_wait_is_busy(self):
+        scheduler = DomainScheduler(wait=0.5, min_delay=1, max_delay=4)
+        self.request(scheduler)
+        with self.assertRaises(DomainBusyError):
+            self.request(scheduler)
+        self.assertEqual(self.clock.sleeps, [])
+
+    def test_concurrency_is_capped_by_domain(self):
+        scheduler = DomainScheduler(max_per_domain=1, wait=0, min_delay=0)
+        with scheduler.slot("example.org"):
+            with self.assertRaises(DomainBusyError):
+                self.request(scheduler)
+            self.request(scheduler, "example.com")
+        self.request(scheduler)
+
+    def test_throttling_slows_the_domain_down_until_it_recovers(self):
+        scheduler = DomainScheduler(min_delay=0.5, max_delay=2)
+        self.request(scheduler)
+        scheduler.report("example.org", 429)
+        self.assertEqual(self.request(scheduler), 1)
+        scheduler.report("example.org", 503)
+        scheduler.report("example.org", 503)
+        self.clock.now += 10
+        self.request(scheduler)
+        self.assertEqual(self.request(scheduler), 2)  # Doubled, up to max_delay
+
+        scheduler.report("example.org", None)  # Unknown: no change
+        self.clock.now += 10
+        self.request(scheduler)
+        self.assertEqual(self.request(scheduler), 2)
+
+        for _ in range(20):
+            scheduler.report("example.org", 200)
+        self.clock.now += 10
+        self.request(scheduler)
+        self.assertEqual(self.request(scheduler), 0.5)  # Back to min_delay
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,78 @@
+import os
+import sys
+import unittest
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from tables import StatusTable
+
+
+class StubStatusTable(StatusTable):
+    """A StatusTable whose queries are recorded and answered with canned rows, instead of going to bigquery."""
+    table_id = "project.dataset.status"
+
+    def __init__(self):
+        super().__init__()
+        self.signature = None
+        self.rows = []
+        self.queries = []
+
+    def Query(self, query, params = None):
+        self.queries.append({param.name: param.value for param in params or []})
+        return self.rows
+
+    def _Signature(self):
+        return self.signature
+
+
+class GetNewURLsTest(unittest.TestCase):
+    def setUp(self):
+        self.table = StubStatusTable()
+        self.table.watermark_lag = timedelta(minutes = 10)
+
+    def test_first_query_reads_the_whole_table(self):
+        self.table.GetNewURLs(incremental = True)
+        self.assertEqual(self.table.queries, [{}])
+
+    def test_incremental_queries_start_at_the_watermark(self):
+        before = datetime.utcnow()
+        self.table.GetNewURLs()
+        self.table.signature = "changed"
+        self.table.GetNewURLs(incremental = True)
+        since = self.table.queries[-1]["since"]
+        self.assertGreaterEqual(since, before - timedelta(minutes = 10))
+        self.assertLessEqual(since, datetime.utcnow() - timedelta(minutes = 10))
+
+    def test_unchanged_table_is_not_queried_again(self):
+        self.table.signature = "same"
+        self.table.GetNewURLs()
+        self.assertEqual(self.table.GetNewURLs(incremental = True), [])
+        self.assertEqual(len(self.table.queries), 1)
+
+        self.table.GetNewURLs()  # Full scans always run
+        self.assertEqual(len(self.table.queries), 2)
+
+    def test_full_page_resumes_from_its_last_row(self):
+        self.table.signature = "same"
+        self.table.max_new_urls = 2
+        last = datetime(2021, 1, 1, 12, 0)
+        self.table.rows = [{"timestamp": last - timedelta(hours = 1)}, {"timestamp": last}]
+        self.table.GetNewURLs()
+
+        self.table.rows = []
+        self.table.GetNewURLs(incremental = True)  # Same signature, but there were more rows to read
+        self.assertEqual(self.table.queries[-1], {"since": last - timedelta(minutes = 10)})
+
+    def test_rewind_reads_the_rows_again(self):
+        self.table.signature = "same"
+        self.table.GetNewURLs()
+        sent = datetime.utcnow() - timedelta(hours = 2)
+        self.table.RewindWatermark(sent)
+
+        self.table.GetNewURLs(incremental = True)
+        self.assertEqual(self.table.queries[-1], {"since": sent - timedelta(minutes = 10)})
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,322 @@
+import os
+import queue
+import threading
+from contextlib import contextmanager
+
+import psutil
+from selenium import webdriver
+from selenium.common.exceptions import TimeoutException, WebDriverException
+from webdriver_manager.chrome import ChromeDriverManager
+
+from metrics import metrics
+
+
+# Directory of the pool's disk caches, one per pool slot, kept when a slot's browser is replaced so static
+# assets aren't downloaded again. Unset: each browser has its own, thrown away with it
+CACHE_DIR = os.environ.get("BROWSER_CACHE_DIR") or None
+
+
+def start_browser(driver_path, headless=True, cache_dir=None):
+    """
+    Starts a new chromedriver + Chrome session, with the options
+    centaurminer.MiningEngine uses for its own webdrivers, in a lean profile:
+    no images, extensions, background services or first-run pages.
+
+    Attributes:
+        driver_path (str): A path to a chromium webdriver.
+        headless (bool): If False, the browser opens a GUI.
+        cache_dir (str): Directory of the browser's disk cache. It mustn't
+                         be used by any other running browser. Default is
+                         None, a temporary one.
+
+    Returns:
+        (selenium.webdriver.Chrome): The new webdriver.
+    """
+    chrome_options = webdriver.ChromeOptions()
+    chrome_options.add_argument('--disable-dev-shm-usage')
+    chrome_options.add_argument("--disable-logging")
+    chrome_options.add_argument("log-level=3")
+    chrome_options.add_argument('--no-sandbox')
+    chrome_options.add_argument("--disable-gpu")
+    chrome_options.add_argument("--kiosk")
+    chrome_options.add_argument("--disable-extensions")
+    chrome_options.add_argument("--blink-settings=imagesEnabled=false")
+    chrome_options.add_argument("--disable-background-networking")
+    chrome_options.add_argument("--disable-component-update")
+    chrome_options.add_argument("--disable-default-apps")
+    chrome_options.add_argument("--disable-sync")
+    chrome_options.add_argument("--no-first-run")
+    chrome_options.add_argument("--mute-audio")
+    if cache_dir is not None:
+        chrome_options.add_argument(f"--disk-cache-dir={cache_dir}")
+    if headless:
+        chrome_options.add_argument('--headless')
+    else:
+        chrome_options.add_argument("--window-size=1920,1080")
+        chrome_options.add_argument("--start-maximized")
+    chrome_options.add_experimental_option('prefs', {
+        "download.default_directory": os.getcwd(),
+        "download.prompt_for_download": False,
+        "download.directory_upgrade": True,
+        "plugins.always_open_pdf_externally": True,
+        "profile.managed_default_content_settings.images": 2
+    })
+    wd = webdriver.Chrome(driver_path, options=chrome_options)
+    wd.implicitly_wait(0)  # Lookups never wait - see BaseEngine.ready_element instead
+    return wd
+
+
+class BrowserPool:
+    """
+    A fixed number of warm browser sessions shared by the worker threads.
+
+    Sessions are started when the pool is created and lent out one at a time
+    with `lease()`. Between leases a session is reset (cookies, storage and
+    extra windows cleared), and a session that crashed or stopped answering is
+    quit and replaced by a fresh one. A page that timed out is only stopped:
+    the session is kept if it resets fine.
+
+    Chrome leaks memory over time, so a session is also retired once it has
+    loaded `max_pages` articles, or once it (chromedriver, Chrome and all of
+    Chrome's processes) uses more than `max_rss_mb` MB of memory. Retired and
+    broken sessions are replaced from a background thread: the lease that
+    found them out returns right away, and the pool is one session short
+    until the new one is up.
+
+    Each of the `size` slots of the pool has its own disk cache directory
+    in `cache_dir`. A slot's new browser only starts once the previous one
+    has fully exited, as Chrome's cache can't be shared between processes.
+
+    Attributes:
+        size (int): Number of browser sessions kept by the pool.
+        driver_path (str): A path to a chromium webdriver. Default is None,
+                           which installs/caches one with webdriver_manager.
+        headless (bool): If False, the browsers open a GUI. Default is True.
+        background (bool): If True, the webdriver is installed and the
+                           sessions started from a background thread, so
+                           creating the pool returns at once. Leases wait for
+                           the sessions that aren't started yet. Default is
+                           False.
+        max_pages (int): Leases after which a session is retired. Default is
+                         None (no limit).
+        max_rss_mb (float): Resident memory (MB) above which a session is
+                            retired, checked after each lease. Default is
+                            None (no limit).
+        cache_dir (str): Directory of the slots' disk caches. Default is
+                         CACHE_DIR, set with the BROWSER_CACHE_DIR
+                         environment variable.
+    """
+    def __init__(self, size=1, driver_path=None, headless=True, background=False, max_pages=None, max_rss_mb=None,
+                 cache_dir=CACHE_DIR):
+        self.size = size
+        self.driver_path = driver_path
+        self.headless = headless
+        self.max_pages = max_pages
+        self.max_rss_mb = max_rss_mb
+        self.cache_dir = cache_dir
+        self._pages = {}
+        self._slots = {}
+        self._free_slots = list(range(size))
+        self._idle = queue.Queue()
+        self._closed = False
+        self._lock = threading.Lock()
+        if background:
+            threading.Thread(target=self._fill, name="browser-pool", daemon=True).start()
+        else:
+            self._install()
+            for _ in range(size):
+                self._idle.put(self._start())
+
+    def _fill(self):
+        """Starts the pool's sessions one by one. A session that fails to start is retried on its first lease."""
+        try:
+            self._install()
+        except Exception:
+            pass
+        for _ in range(self.size):
+            try:
+                wd = self._start()
+            except Exception:
+                wd = None
+            self._release(wd)
+
+    def _install(self):
+        if self.driver_path is None:
+            self.driver_path = ChromeDriverManager().install()
+
+    @contextmanager
+    def lease(self, timeout=None):
+        """
+        Borrows a healthy browser session for the duration of a `with` block.
+
+        Attributes:
+            timeout (float): Seconds to wait for a free session. Default is
+                             None, which waits forever.
+
+        Raises:
+            queue.Empty: If no session was freed within `timeout`.
+        """
+        wd = self._idle.get(timeout=timeout)
+        try:
+            if wd is None or not self._is_healthy(wd):
+                wd = self._replace(wd)
+        except Exception:
+            self._idle.put(None)  # Keep the slot, try to start it again on the next lease
+            raise
+
+        broken = False
+        try:
+            yield wd
+        except TimeoutException:  # A slow page (or an exceeded budget), not a broken browser
+            broken = not self._stop(wd)
+            raise
+        except WebDriverException:
+            broken = True
+            raise
+        finally:
+            reason = "broken" if broken else self._retire_reason(wd)
+            if reason is None and not self._reset(wd):
+                reason = "broken"
+            if reason is None:
+                self._release(wd)
+            else:
+                metrics.inc("browsers_recycled_total", reason=reason)
+                threading.Thread(target=self._refill, args=(wd,), name="browser-pool", daemon=True).start()
+
+    def close(self):
+        """Quits every idle browser session. Leased ones are quit on release."""
+        with self._lock:
+            self._closed = True
+        while True:
+            try:
+                wd = self._idle.get_nowait()
+            except queue.Empty:
+                break
+            self._quit(wd)
+
+    def _release(self, wd):
+        with self._lock:
+            if not self._closed:
+                self._idle.put(wd)
+                return
+        self._quit(wd)
+
+    def _replace(self, wd):
+        self._quit(wd)
+        self._install()
+        return self._start()
+
+    def _start(self):
+        """Starts a browser in a free slot, with that slot's disk cache."""
+        with self._lock:
+            slot = self._free_slots.pop(0) if self._free_slots else None
+        cache_dir = None
+        if self.cache_dir is not None and slot is not None:
+            cache_dir = os.path.join(self.cache_dir, f"slot-{slot}")
+        try:
+            wd = start_browser(self.driver_path, self.headless, cache_dir)
+        except Exception:
+            self._free_slot(slot)
+            raise
+        if slot is not None:
+            with self._lock:
+                self._slots[wd] = slot
+        return wd
+
+    def _free_slot(self, slot):
+        if slot is not None:
+            with self._lock:
+                self._free_slots.append(slot)
+
+    def _refill(self, wd):
+        """Replaces a session, and puts the new one (or None if it didn't start) back in the pool."""
+        try:
+            wd = self._replace(wd)
+        except Exception:
+            wd = None
+        self._release(wd)
+
+    def _retire_reason(self, wd):
+        """Counts the lease that just ended, and returns why the session should be retired, if it should."""
+        with self._lock:
+            pages = self._pages[wd] = self._pages.get(wd, 0) + 1
+        if self.max_pages and pages >= self.max_pages:
+            return "pages"
+        if self.max_rss_mb and self.rss_mb(wd) > self.max_rss_mb:
+            return "memory"
+        return None
+
+    @staticmethod
+    def rss_mb(wd):
+        """Returns the resident memory (MB) of a session's chromedriver and every process under it (Chrome's)."""
+        rss = 0
+        for process in BrowserPool._processes(wd):
+            try:
+                rss += process.memory_info().rss
+            except psutil.Error:  # Exited meanwhile
+                pass
+        return rss / 2 ** 20
+
+    @staticmethod
+    def _processes(wd):
+        """Returns a session's chromedriver and every process under it (Chrome's)."""
+        try:
+            driver = psutil.Process(wd.service.process.pid)
+            return [driver] + driver.children(recursive=True)
+        except (AttributeError, psutil.Error):
+            return []
+
+    @staticmethod
+    def _is_healthy(wd):
+        if wd.service.process is None or wd.service.process.poll() is not None:
+            return False
+        try:
+            wd.current_url
+        except WebDriverException:
+            return False
+        return True
+
+    @staticmethod
+    def _stop(wd):
+        """Stops the page still loading after a timeout."""
+        try:
+            wd.execute_script("window.stop()")
+        except WebDriverException:
+            return False
+        return True
+
+    @staticmethod
+    def _reset(wd):
+        """Clears everything the previous lease left behind in the session."""
+        try:
+            for handle in wd.window_handles[1:]:
+                wd.switch_to.window(handle)
+                wd.close()
+            wd.switch_to.window(wd.window_handles[0])
+            wd.execute_script("try { localStorage.clear(); sessionStorage.clear(); } catch (e) {}")
+            wd.execute_cdp_cmd("Network.clearBrowserCookies", {})
+            wd.get("about:blank")
+        except WebDriverException:
+            return False
+        return True
+
+    def _quit(self, wd):
+        """Quits a session, and frees its slot once all of its processes have exited."""
+        if wd is None:
+            return
+        with self._lock:
+            self._pages.pop(wd, None)
+            slot = self._slots.pop(wd, None)
+        processes = self._processes(wd)
+        try:
+            wd.quit()
+        except Exception:
+            pass
+        _, alive = psutil.wait_procs(processes, timeout=10)
+        for process in alive:
+            try:
+                process.kill()
+            except psutil.Error:
+                pass
+        psutil.wait_procs(alive, timeout=5)
+        self._free_slot(slot)  # Only now: the next browser of the slot would share its disk cache
@@ -0,0 +1,64 @@
+import random
+import logging
+import functools
+from google.cloud import logging as cloud_logging
+from google.cloud.logging.handlers import CloudLoggingHandler
+from google.cloud.logging.handlers.transports import BackgroundThreadTransport
+
+logger = logging.getLogger("miner")
+
+
+class TruncateFilter(logging.Filter):
+    """Cuts every log message down to `max_chars` characters."""
+    def __init__(self, max_chars):
+        super().__init__()
+        self.max_chars = max_chars
+
+    def filter(self, record):
+        message = record.getMessage()
+        if len(message) > self.max_chars:
+            record.msg = message[:self.max_chars] + f"... [{len(message) - self.max_chars} more characters]"
+            record.args = ()
+        return True
+
+
+class SampleFilter(logging.Filter):
+    """Lets through only a `rate` fraction of the records logged with extra={"sampled": True}."""
+    def __init__(self, rate):
+        super().__init__()
+        self.rate = rate
+
+    def filter(self, record):
+        return not getattr(record, "sampled", False) or random.random() < self.rate
+
+
+def setup_logging(worker_name, log_file=None, max_chars=2000, sample_rate=0.01, batch_size=50, max_latency=5):
+    """
+    Sends the "miner" logger's records to google cloud logging, and to `log_file` if given.
+
+    Records are queued and shipped in batches of up to `batch_size` from a background thread (or after
+    `max_latency` seconds), so logging never waits on the API. Messages longer than `max_chars` are cut,
+    and only a `sample_rate` fraction of the verbose records (see `log_sampled`) are kept.
+
+    Returns:
+        (logging.Logger): The configured logger.
+    """
+    transport = functools.partial(BackgroundThreadTransport, batch_size=batch_size, max_latency=max_latency)
+    handlers = [CloudLoggingHandler(cloud_logging.Client(), name=worker_name, transport=transport)]
+    if log_file:
+        handlers.append(logging.FileHandler(log_file))
+
+    formatter = logging.Formatter(worker_name + ": %(message)s")
+    for handler in handlers:
+        handler.setFormatter(formatter)
+        logger.addHandler(handler)
+    logger.addFilter(SampleFilter(sample_rate))
+    logger.addFilter(TruncateFilter(max_chars))
+    logger.setLevel(logging.INFO)
+    logger.propagate = False
+    return logger
+
+
+def log_sampled(message, *args):
+    """Logs a verbose message (like a whole article), which is kept only for a sample of the calls."""
+    logger.info(message, *args, extra={"sampled": True})
@@ -1,6 +1,108 @@
-from .arxiv_miner import ArxivMiner
-from .biorxiv_miner import BiorxivMiner
-from .ibmcru_miner import IbmcRuMiner
-from .medrxiv_miner import MedrxivMiner
-from .preprints_miner import PreprintsMiner
-from .scielo_miner import ScieloMiner
+"""
+Registry of the site miners, by domain.
+
+A miner is a class with an `engine` (a BaseEngine subclass) and the
+`locations` (a centaurminer.PageLocations subclass) it mines a site's
+articles with. Miners are registered as "module:Class" strings, and a
+miner's module is only imported when its first article is mined.
+
+Miners from other packages are registered with entry points in the
+"data_pipeline.miners" group, named after the domain they mine, e.g. in
+setup.py: entry_points={"data_pipeline.miners": ["example.org = example_miner:ExampleMiner"]}
+"""
+
+import importlib
+import threading
+from functools import lru_cache
+from importlib.metadata import entry_points
+from urllib.parse import urlsplit
+from tld import get_fld
+
+ENTRY_POINT_GROUP = "data_pipeline.miners"
+
+# Miners by domain (as returned by domain_of): a "module:Class" string until it's first used, then the class
+_miners = {
+    'ibmc.msk.ru': "miners.ibmcru_miner:IbmcRuMiner",
+    'arxiv.org': "miners.arxiv_miner:ArxivMiner",
+    'biorxiv.org': "miners.biorxiv_miner:BiorxivMiner",
+    'medrxiv.org': "miners.medrxiv_miner:MedrxivMiner",
+    'scielo.br': "miners.scielo_miner:ScieloMiner",
+    'sld.cu': "miners.scielo_miner:ScieloMiner",
+    'preprints.org': "miners.preprints_miner:PreprintsMiner",
+}
+_entry_points_loaded = False
+_lock = threading.Lock()
+
+
+def register(domain, miner):
+    """
+    Adds (or replaces) the miner of a domain.
+
+    Args:
+        domain (str): A domain, as returned by domain_of.
+        miner (type or str): A miner class, or a "module:Class" string
+                             to import it from when it's first used.
+    """
+    with _lock:
+        _miners[domain] = miner
+
+
+def get(domain):
+    """
+    Returns the miner class of a domain, importing its module if needed.
+
+    Args:
+        domain (str): A domain, as returned by domain_of.
+
+    Raises:
+        KeyError: If no miner is registered for the domain.
+    """
+    with _lock:
+        _load_entry_points()
+        miner = _miners[domain]
+        if isinstance(miner, str):
+            module, _, name = miner.partition(":")
+            miner = _miners[domain] = getattr(importlib.import_module(module), name)
+        return miner
+
+
+def domains():
+    """Returns the domains that have a miner."""
+    with _lock:
+        _load_entry_points()
+        return sorted(_miners)
+
+
+def domain_of(url, fail_silently=False):
+    """
+    Returns the domain of a url (its first-level domain), like `get_fld`.
+
+    The lookup is done once per site, not once per url.
+
+    Args:
+        url (str): An article url.
+        fail_silently (bool): If True, returns None for a url without a
+                              known domain, instead of raising.
+    """
+    parts = urlsplit(url)
+    return _domain_of_site(f"{parts.scheme}://{parts.netloc}", fail_silently)
+
+
+@lru_cache(maxsize=4096)
+def _domain_of_site(site, fail_silently):
+    return get_fld(site, fail_silently=fail_silently)
+
+
+def _load_entry_points():
+    """Registers the installed entry points' miners, the first time it's called. Expects _lock to be held."""
+    global _entry_points_loaded
+    if _entry_points_loaded:
+        return
+    _entry_points_loaded = True
+    found = entry_points()
+    if hasattr(found, "select"):
+        found = found.select(group=ENTRY_POINT_GROUP)
+    else:
+        found = found.get(ENTRY_POINT_GROUP, ())
+    for entry_point in found:
+        _miners[entry_point.name] = entry_point.value
@@ -4,6 +4,7 @@ Edited by Gulnoza Kh. on 2020-11-09
 """
 
 import centaurminer as mining
+from .engine import BaseEngine
 
 
 class ArxivMiner:
@@ -30,7 +31,7 @@ class ArxivMiner:
         search_keyword = ''
         source_impact_factor = ''
 
-    class ArxivEngine(mining.MiningEngine):
+    class ArxivEngine(BaseEngine):
         def get_authors(self, element):
             return mining.TagList(self.get(element, several=True), tag='author')
 
@@ -40,3 +41,6 @@ class ArxivMiner:
             if date is not None:
                 return date.replace('/', '-')
             return date
+
+    engine = ArxivEngine
+    locations = ArxivLocations
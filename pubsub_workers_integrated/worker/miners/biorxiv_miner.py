@@ -4,6 +4,7 @@ Edited by Gulnoza Kh. on 2020-12-17
 """
 
 import centaurminer as mining
+from .engine import BaseEngine
 
 
 class BiorxivMiner:
@@ -27,7 +28,10 @@ class BiorxivMiner:
         search_keyword = ''
         source_impact_factor = ''
 
-    class BiorxivEngine(mining.MiningEngine):
+    class BiorxivEngine(BaseEngine):
+        # Everything is in the static HTML (mostly <meta> tags), no need for a browser
+        use_browser = False
+
         def get_authors(self, element):
             return mining.TagList(self.get(element, several=True), tag='author')
       
@@ -36,3 +40,6 @@ class BiorxivMiner:
 
         def get_references(self, element):
             return self.get(element, several=True)
+
+    engine = BiorxivEngine
+    locations = BiorxivLocations
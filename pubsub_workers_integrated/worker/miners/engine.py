@@ -0,0 +1,456 @@
+"""
+Shared mining engine for the site miners.
+"""
+
+import re
+import time
+import threading
+import centaurminer as mining
+import lxml.html
+import requests
+from datetime import date
+from requests.adapters import HTTPAdapter
+from selenium.common.exceptions import JavascriptException, TimeoutException
+from selenium.webdriver.common.by import By
+from selenium.webdriver.support import expected_conditions
+from selenium.webdriver.support.ui import WebDriverWait
+from webdriver_manager.chrome import ChromeDriverManager
+
+from browser_pool import start_browser
+
+HTTP_HEADERS = {
+    "User-Agent": "Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 (KHTML, like Gecko) "
+                  "Chrome/87.0.4280.88 Safari/537.36",
+    "Accept": "text/html,application/xhtml+xml,application/xml;q=0.9,*/*;q=0.8",
+    "Accept-Language": "en-US,en;q=0.9",
+}
+
+# Reads a list of [kind, selector, attribute] locators in the page, in one go. Each locator
+# gives the list of values of all its matches (null if it couldn't be evaluated), read the
+# same way selenium's WebElement.text / get_attribute would. Also returns the HTTP status the
+# page was served with, where the browser exposes it.
+EXTRACT_SCRIPT = """
+var locators = arguments[0];
+function find(kind, selector) {
+    if (kind === "css") {
+        return Array.prototype.slice.call(document.querySelectorAll(selector));
+    }
+    var result = document.evaluate(selector, document, null, XPathResult.ORDERED_NODE_SNAPSHOT_TYPE, null);
+    var nodes = [];
+    for (var i = 0; i < result.snapshotLength; i++) {
+        nodes.push(result.snapshotItem(i));
+    }
+    return nodes;
+}
+function read(node, attribute) {
+    if (attribute === null) {
+        if (node !== document.body && node.getClientRects().length === 0) {
+            return "";  // Not displayed
+        }
+        return (node.innerText || "").trim();
+    }
+    var value = node[attribute];
+    if (value === undefined || value === null || typeof value === "object" || typeof value === "function") {
+        value = node.getAttribute(attribute);
+    }
+    return value === null ? null : String(value);
+}
+var status = null;
+try {
+    var navigation = performance.getEntriesByType("navigation")[0];
+    if (navigation && navigation.responseStatus) {
+        status = navigation.responseStatus;
+    }
+} catch (e) {}
+return {
+    status: status,
+    values: locators.map(function (locator) {
+        try {
+            return find(locator[0], locator[1]).filter(function (node) {
+                return node.nodeType === Node.ELEMENT_NODE;
+            }).map(function (node) {
+                return read(node, locator[2]);
+            });
+        } catch (e) {
+            return null;
+        }
+    })
+};
+"""
+
+# URL patterns (as Network.setBlockedURLs takes them) of the resource types an engine can block
+RESOURCE_URL_PATTERNS = {
+    "image": ("*.png", "*.png?*", "*.jpg", "*.jpg?*", "*.jpeg", "*.jpeg?*", "*.gif", "*.gif?*",
+              "*.webp", "*.webp?*", "*.svg", "*.svg?*", "*.ico", "*.ico?*"),
+    "font": ("*.woff", "*.woff?*", "*.woff2", "*.woff2?*", "*.ttf", "*.ttf?*", "*.otf", "*.otf?*",
+             "*.eot", "*.eot?*"),
+    "media": ("*.mp4", "*.mp4?*", "*.webm", "*.webm?*", "*.mp3", "*.mp3?*", "*.ogg", "*.ogg?*"),
+    "stylesheet": ("*.css", "*.css?*"),
+}
+
+# Ads, analytics, widgets and math rendering, which don't change the text of an article page
+BLOCKED_URLS = (
+    "*google-analytics.com/*", "*googletagmanager.com/*", "*doubleclick.net/*",
+    "*googlesyndication.com/*", "*connect.facebook.net/*", "*platform.twitter.com/*",
+    "*hotjar.com/*", "*scorecardresearch.com/*", "*addthis.com/*", "*altmetric.com/*",
+    "*/MathJax.js*", "*/mathjax/*", "*/MathJax/*",
+)
+
+_sessions = threading.local()
+
+
+class BudgetExceededError(TimeoutException):
+    """Raised when the page would have to be loaded or waited for past the engine's deadline."""
+
+
+def http_session():
+    """Returns this thread's requests.Session, keeping its connections open between articles."""
+    session = getattr(_sessions, "session", None)
+    if session is None:
+        session = requests.Session()
+        session.headers.update(HTTP_HEADERS)
+        adapter = HTTPAdapter(pool_connections=8, pool_maxsize=8, max_retries=2)
+        session.mount("http://", adapter)
+        session.mount("https://", adapter)
+        _sessions.session = session
+    return session
+
+
+class BaseEngine(mining.MiningEngine):
+    """Mining engine that can work on a webdriver it doesn't own, or without one.
+
+    centaurminer.MiningEngine starts a new chromedriver + Chrome in its
+    constructor. Passing `wd` skips that and mines with an already running
+    session instead, which is how the worker lends its warm browsers
+    (see browser_pool.BrowserPool) to the site miners.
+
+    In a browser, every location of the PageLocations is read with a single
+    injected script right after the page loads (see `prefetch`), instead of
+    one WebDriver round trip per element. get() answers from those values,
+    and only goes back to the browser for elements the page locations don't
+    declare.
+
+    Pages are read as soon as they're loaded. Engines whose pages fill in
+    their content with JavaScript can set `ready_element`, which is waited
+    for once (up to `ready_timeout` seconds) before anything is read. After
+    that, lookups never wait: locations named in the PageLocations'
+    `_optional` tuple are only read from what's already on the page, and
+    other elements the prefetch didn't cover are waited for at most
+    `element_timeout` seconds (none by default).
+
+    Passing `deadline` (a time.monotonic() value) gives the gather a time
+    budget: page loads and waits never run past it, and once it's passed,
+    the optional locations left are skipped (listed in `skipped`) so the
+    required ones still make it into a partial record. If the page can't
+    even be loaded and ready by then, BudgetExceededError is raised.
+
+    Passing `fields` restricts gathering to those locations, for callers
+    that only store some of them; the others are neither looked up nor
+    included in `results`.
+
+    `status_code` is the HTTP status of the last page, if known (in a
+    browser, only from Chrome 109 on).
+
+    The seconds spent on each stage of the last gather ("load", "ready",
+    "prefetch") are kept in `timings`, and those spent on each location in
+    `field_timings`.
+
+    Miners whose pages don't need JavaScript can set `use_browser = False`.
+    The page is then fetched over plain HTTP and parsed with lxml, and the
+    same PageLocations (css selectors, xpaths, MetaData) and get_<key>
+    methods are evaluated against it, without any browser at all.
+
+    In a browser, the requests for `blocked_resources` (keys of
+    RESOURCE_URL_PATTERNS) and for urls matching `blocked_urls` fail
+    without being sent. By default that's images, fonts, media, and the
+    ads, analytics and MathJax in BLOCKED_URLS. Engines can extend or
+    replace both, e.g. `blocked_urls = BaseEngine.blocked_urls + ("*/widget/*",)`.
+    Stylesheets aren't blocked by default, as they decide what text is
+    displayed.
+
+    Args:
+        site_locations: centaurminer.PageLocations subclass to be gathered.
+        driver_path (str, optional): Path to a chromium webdriver. Only used
+            when `wd` is None.
+        headless (bool, optional): Only used when `wd` is None.
+        wd (selenium.webdriver, optional): Running webdriver to mine with.
+        fields (set, optional): Names of the locations to gather. Defaults
+            to all of them.
+        deadline (float, optional): time.monotonic() by which the gather
+            should be done.
+    """
+
+    use_browser = True
+    http_timeout = 30
+    ready_element = None
+    ready_timeout = 10
+    element_timeout = 0
+    page_load_timeout = 300
+    blocked_resources = ("image", "font", "media")
+    blocked_urls = BLOCKED_URLS
+
+    def __init__(self, site_locations, driver_path=None, headless=True, wd=None, fields=None, deadline=None):
+        self.owns_driver = self.use_browser and wd is None
+        if self.owns_driver:
+            super().__init__(site_locations, driver_path=driver_path, headless=headless)
+        else:
+            self.site = site_locations
+            self.wd = wd
+            self.results = {}
+        self.fields = fields
+        self.deadline = deadline
+        self.skipped = []
+        self.page = None
+        self.status_code = None
+        self.timings = {}
+        self.field_timings = {}
+        self._found = {}
+        self._field = None
+
+    def close(self):
+        """Quits the webdriver, unless it was lent to this engine."""
+        if self.owns_driver and self.wd is not None:
+            self.wd.quit()
+            self.wd = None
+
+    def remaining(self, timeout):
+        """Returns `timeout`, cut down to the seconds left before self.deadline.
+
+        Raises:
+            BudgetExceededError: If the deadline has passed.
+        """
+        if self.deadline is None:
+            return timeout
+        left = self.deadline - time.monotonic()
+        if left <= 0:
+            raise BudgetExceededError(f"Out of time ({-left:.1f}s past the deadline)")
+        return min(timeout, left)
+
+    def over_budget(self):
+        return self.deadline is not None and time.monotonic() >= self.deadline
+
+    def load(self, url):
+        """Opens the page at `url`, in the browser or over HTTP.
+
+        Raises:
+            requests.RequestException: If the page couldn't be fetched over
+                HTTP, or the server failed (5xx, except 503, which is left to
+                the caller like 404, 410 and 429).
+        """
+        if self.use_browser:
+            # Always set, as the webdriver may be reused by engines with other deadlines and blocked urls
+            self.wd.set_page_load_timeout(self.remaining(self.page_load_timeout))
+            self.block_requests()
+            self.wd.get(url)
+            return
+        response = http_session().get(url, timeout=self.remaining(self.http_timeout))
+        self.status_code = response.status_code
+        if response.status_code >= 500 and response.status_code != 503:
+            response.raise_for_status()
+        self.page = lxml.html.document_fromstring(response.content, base_url=response.url)
+        self.page.make_links_absolute(response.url, handle_failures="ignore")
+
+    def block_requests(self):
+        """Makes the browser fail the requests for self.blocked_resources and self.blocked_urls."""
+        patterns = [pattern for resource in self.blocked_resources for pattern in RESOURCE_URL_PATTERNS[resource]]
+        patterns.extend(self.blocked_urls)
+        self.wd.execute_cdp_cmd("Network.enable", {})
+        self.wd.execute_cdp_cmd("Network.setBlockedURLs", {"urls": patterns})
+
+    def _init_selenium(self, driver_path=None, headless=True):
+        """Starts the engine's own browser, with the same lean profile as the pool's."""
+        if driver_path is None:
+            driver_path = ChromeDriverManager().install()
+        return start_browser(driver_path, headless)
+
+    def wait_until_ready(self):
+        """Waits for self.ready_element to be on the page, if the engine has one.
+
+        Returns:
+            False if it didn't show up within self.ready_timeout seconds.
+
+        Raises:
+            BudgetExceededError: If it didn't show up before self.deadline.
+        """
+        if self.ready_element is None or not self.use_browser:
+            return True
+        locator = (self.ready_element.method, self.ready_element.selector)
+        timeout = self.remaining(self.ready_timeout)
+        try:
+            WebDriverWait(self.wd, timeout).until(expected_conditions.presence_of_element_located(locator))
+        except TimeoutException:
+            if self.over_budget():
+                raise BudgetExceededError("The page wasn't ready before the deadline")
+            return False
+        return True
+
+    def locations(self):
+        """Names of the locations of self.site that gather() evaluates."""
+        return [info for info in self.site._elements() if self.fields is None or info in self.fields]
+
+    def prefetch(self):
+        """Reads the values of every element of self.site with one execute_script call.
+
+        Besides the locations, this includes the private elements of the PageLocations
+        (like `_citation_date`), which get_<key> methods can use as fallbacks.
+        """
+        locators = {}
+        names = self.locations() + [name for name in dir(self.site) if name.startswith("_")]
+        for info in names:
+            if info.startswith("__"):
+                continue
+            locator = self._locator(getattr(self.site, info))
+            if locator is not None:
+                locators[locator] = None
+        locators = list(locators)
+        try:
+            page = self.wd.execute_script(EXTRACT_SCRIPT, [list(locator) for locator in locators])
+        except JavascriptException:
+            page = {"status": None, "values": []}
+        self.status_code = page["status"]
+        values = page["values"]
+        self._found = {locator: value for locator, value in zip(locators, values) if value is not None}
+
+    @staticmethod
+    def _locator(element):
+        """Translates an Element into a (kind, selector, attribute) key for EXTRACT_SCRIPT, if possible."""
+        if not isinstance(element, mining.Element) or element.needsInstructions:
+            return None
+        method, selector = element.method, element.selector
+        if method == By.XPATH:
+            kind = "xpath"
+        elif method == By.CSS_SELECTOR:
+            kind = "css"
+        elif method in (By.ID, By.NAME):
+            kind = "css"
+            selector = '[{}="{}"]'.format(method, selector.replace('\\', '\\\\').replace('"', '\\"'))
+        elif method == By.TAG_NAME:
+            kind = "css"
+        else:
+            return None
+        return kind, selector, element.attribute
+
+    def gather(self, url):
+        """Gathers the information denoted in self.site from a single page.
+
+        Same as centaurminer.MiningEngine.gather, but the page may be
+        loaded without a browser, and in a browser all the elements are
+        read at once.
+        """
+        self.results = {}  # Reset for subsequent gathers
+        self.status_code = None
+        self.timings = {}
+        self.field_timings = {}
+        self.skipped = []
+        self._found = {}
+
+        self._timed("load", self.load, url)
+        if self.use_browser:
+            self._timed("ready", self.wait_until_ready)
+            self._timed("prefetch", self.prefetch)
+
+        for info in self.locations():
+            get_func = getattr(self, "get_" + info, None)
+            element = getattr(self.site, info)
+
+            # Check for strings - just store them directly
+            if isinstance(element, str):
+                self.results[info] = element
+                continue
+
+            if get_func is None and element.needsInstructions:
+                print(self.site.__name__ + "." + info, "needs further instructions to process - add it to the engine.")
+                continue
+            elif get_func is None:
+                get_func = self.get
+            if info in getattr(self.site, "_optional", ()) and self.over_budget():
+                self.results[info] = None
+                self.skipped.append(info)
+                continue
+            self._field = info
+            start = time.perf_counter()
+            self.results[info] = get_func(element)
+            self.field_timings[info] = time.perf_counter() - start
+        self._field = None
+        self.results['url'] = url
+        self.results['date_aquisition'] = date.today().strftime("%Y-%m-%d")
+
+    def get(self, element, several=False):
+        """Extracts an element from the page, like centaurminer.MiningEngine.get."""
+        if self.use_browser:
+            values = self._found.get(self._locator(element))
+            if values is None:
+                return self._get_live(element, several)
+            if several:
+                return list(values)
+            return values[0] if values else None
+        if element is None:
+            return None
+        nodes = self._find(element)
+        if several:
+            return [self._extract_node(element, node) for node in nodes]
+        if not nodes:
+            return None
+        return self._extract_node(element, nodes[0])
+
+    def _get_live(self, element, several):
+        """Looks an element up in the browser, for elements the prefetch didn't cover."""
+        if element is None:
+            return None
+        if self._field in getattr(self.site, "_optional", ()):
+            if self._found:  # Optional fields only look at the prefetched page
+                return [] if several else None
+        elif self.element_timeout and not element.needsInstructions and not self.over_budget():
+            try:
+                WebDriverWait(self.wd, self.remaining(self.element_timeout)).until(
+                    lambda wd: wd.find_elements(element.method, element.selector))
+            except TimeoutException:
+                pass
+        return super().get(element, several)
+
+    def _timed(self, stage, func, *args):
+        start = time.perf_counter()
+        try:
+            return func(*args)
+        finally:
+            self.timings[stage] = time.perf_counter() - start
+
+    def _find(self, element):
+        """Finds the lxml nodes matching a selenium locator."""
+        method, selector = element.method, element.selector
+        if method == By.CSS_SELECTOR:
+            return self.page.cssselect(selector)
+        if method == By.CLASS_NAME:
+            return self.page.cssselect("." + selector)
+        if method == By.ID:
+            xpath, args = "//*[@id=$value]", {"value": selector}
+        elif method == By.NAME:
+            xpath, args = "//*[@name=$value]", {"value": selector}
+        elif method == By.TAG_NAME:
+            xpath, args = "//" + selector, {}
+        elif method == By.LINK_TEXT:
+            xpath, args = "//a[normalize-space(.)=$value]", {"value": selector}
+        elif method == By.PARTIAL_LINK_TEXT:
+            xpath, args = "//a[contains(., $value)]", {"value": selector}
+        else:
+            xpath, args = selector, {}
+        # Relative paths (like MetaData's "html/head/meta") are relative to the document, as in selenium
+        if not xpath.startswith(("/", "(", ".")):
+            xpath = "/" + xpath
+        nodes = self.page.xpath(xpath, **args)
+        return [node for node in nodes if isinstance(node, lxml.html.HtmlElement)]
+
+    @staticmethod
+    def _extract_node(element, node):
+        """Reads the element's text or attribute from an lxml node, the way selenium would."""
+        if element.attribute is None:
+            lines = (re.sub(r"\s+", " ", line).strip() for line in node.text_content().splitlines())
+            return "\n".join(line for line in lines if line)
+        if element.attribute == "innerHTML":
+            return (node.text or "") + "".join(
+                lxml.html.tostring(child, encoding="unicode") for child in node)
+        if element.attribute == "outerHTML":
+            return lxml.html.tostring(node, encoding="unicode", with_tail=False)
+        if element.attribute in ("textContent", "innerText"):
+            return node.text_content()
+        return node.get(element.attribute)
@@ -4,6 +4,7 @@ Edited by Gulnoza Kh. on 2020-11-09
 """
 
 import centaurminer as mining
+from .engine import BaseEngine
 
 
 class IbmcRuMiner:
@@ -33,7 +34,10 @@ class IbmcRuMiner:
         source_impact_factor = ''
         search_keyword = ''
 
-    class IbmcEngine(mining.MiningEngine):
+        # Most articles don't have a citations score - don't wait for it
+        _optional = ('citations',)
+
+    class IbmcEngine(BaseEngine):
         """
         IbmcEngine class sets instructions on how to mine data from
         `http://pbmc.ibmc.msk.ru/`
@@ -54,3 +58,6 @@ class IbmcRuMiner:
             inside `html` like tags.
             """
             return mining.TagList(self.get(element, several=True), tag='org')
+
+    engine = IbmcEngine
+    locations = IbmcLocations
@@ -4,6 +4,7 @@ Edited by Gulnoza Kh. on 2020-11-09
 """
 
 import centaurminer as mining
+from .engine import BaseEngine
 
 
 class MedrxivMiner:
@@ -27,9 +28,15 @@ class MedrxivMiner:
         search_keyword = ''
         source_impact_factor = ''
 
-    class MedrxivEngine(mining.MiningEngine):
+    class MedrxivEngine(BaseEngine):
+        # Everything is in the static HTML (mostly <meta> tags), no need for a browser
+        use_browser = False
+
         def get_authors(self, element):
             return mining.TagList(self.get(element, several=True), tag='author')
 
         def get_organization(self, element):
             return mining.TagList(self.get(element, several=True), tag='organization')
+
+    engine = MedrxivEngine
+    locations = MedrxivLocations
@@ -4,6 +4,7 @@ Edited by Gulnoza Kh. on 2020-12-17
 """
 
 import centaurminer as mining
+from .engine import BaseEngine
 
 
 class PreprintsMiner:
@@ -27,7 +28,10 @@ class PreprintsMiner:
         search_keyword = ''
         source_impact_factor = ''
 
-    class PreprintsEngine(mining.MiningEngine):
+    class PreprintsEngine(BaseEngine):
+        # Everything is in the static HTML (mostly <meta> tags), no need for a browser
+        use_browser = False
+
         def get_authors(self, element):
             return mining.TagList(self.get(element, several=True), tag='author')
 
@@ -36,3 +40,6 @@ class PreprintsMiner:
 
         def get_references(self, element):
             return self.get(element, several=True)
+
+    engine = PreprintsEngine
+    locations = PreprintsLocations
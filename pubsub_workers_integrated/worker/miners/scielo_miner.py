@@ -5,6 +5,7 @@ Edited by Gulnoza Kh. on 2020-12-17
 
 import centaurminer as mining
 import datetime
+from .engine import BaseEngine
 
 
 class ScieloMiner:
@@ -44,7 +45,13 @@ class ScieloMiner:
         search_keyword = ''
         source_impact_factor = ''
 
-    class ScieloEngine(mining.MiningEngine):
+        # Often missing from the page - don't wait for them
+        _optional = ('abstract_translated', 'category', 'date_publication', 'keywords', 'title_translated')
+
+        # Fallback for date_publication, when there's no "Epub" header
+        _citation_date = mining.MetaData("citation_date")
+
+    class ScieloEngine(BaseEngine):
         """Mining Engine to get data from elements declared on centaurminer.PageLocations
 
         Here it's possible to process elements retrieved from centaurminer.PageLocations
@@ -56,6 +63,8 @@ class ScieloMiner:
                 return TagList(self.get(element, several=True))
         """
 
+        ready_element = mining.Element("css_selector", "div.content")
+
         #########################
         ### Utilities Methods ###
         #########################
@@ -140,7 +149,7 @@ class ScieloMiner:
                     date_obj = datetime.datetime.strptime(date_str, '%B %d, %Y').date()
                 return date_obj
             except (AttributeError, IndexError):
-                element = mining.MetaData("citation_date")
+                element = self.site._citation_date
                 try:
                     return datetime.datetime.strptime(self.get(element), "%m/%Y").date()
                 except Exception as e:
@@ -191,3 +200,6 @@ class ScieloMiner:
         def get_extra_link(self, element):
             """Returns a string with link to pdf/s"""
             return self.get(element, several=True)
+
+    engine = ScieloEngine
+    locations = ScieloLocations
@@ -0,0 +1,110 @@
+import time
+import threading
+from contextlib import contextmanager
+
+
+class DomainBusyError(Exception):
+    pass
+
+
+class _Domain:
+    """Pacing state of one domain: a concurrency cap and a token bucket."""
+    def __init__(self, max_per_domain, delay):
+        self.slots = threading.BoundedSemaphore(max_per_domain) if max_per_domain else None
+        self.delay = delay
+        self.tokens = 1.0
+        self.updated = time.monotonic()
+
+
+class DomainScheduler:
+    """
+    Coordinates the worker threads that mine articles from the same domain.
+
+    Each domain has a token bucket that lets one request through every
+    `delay` seconds. The delay starts at min_delay, is doubled (up to
+    max_delay) every time the site answers 429 or 503, and shrinks back
+    towards min_delay by a tenth of the range with every other answer. Each
+    site is so mined as fast as it tolerates, instead of at one slow rate
+    for all of them.
+
+    Attributes:
+        max_per_domain (int): How many articles of one domain may be mined at
+                              the same time. Default is None (no cap).
+        wait (float): Seconds to wait for a free slot on a busy domain before
+                      giving up with DomainBusyError.
+        min_delay (float): Seconds between two requests to the same domain
+                           while it answers normally. Default is 0.1.
+        max_delay (float): Longest the delay grows to while the domain
+                           throttles us. Default is 2.
+    """
+    THROTTLE_STATUSES = (429, 503)
+
+    def __init__(self, max_per_domain=None, wait=30, min_delay=0.1, max_delay=2):
+        self.max_per_domain = max_per_domain
+        self.wait = wait
+        self.min_delay = min_delay
+        self.max_delay = max(max_delay, min_delay)
+        self._domains = {}
+        self._lock = threading.Lock()
+
+    def _domain(self, domain):
+        with self._lock:
+            return self._domains.setdefault(domain, _Domain(self.max_per_domain, self.min_delay))
+
+    @contextmanager
+    def slot(self, domain):
+        """
+        Holds one of the domain's mining slots for the duration of a `with` block,
+        once the domain's delay since the previous request has passed.
+
+        Attributes:
+            domain (str): A domain, as returned by `miners.domain_of`.
+
+        Raises:
+            DomainBusyError: If no slot was freed, or the domain's delay
+                             didn't pass, within self.wait seconds.
+        """
+        state = self._domain(domain)
+        deadline = time.monotonic() + self.wait
+        if state.slots is not None and not state.slots.acquire(timeout=self.wait):
+            raise DomainBusyError(f"{domain} already has {self.max_per_domain} articles being mined")
+        try:
+            self._take_token(domain, state, deadline)
+            yield
+        finally:
+            if state.slots is not None:
+                state.slots.release()
+
+    def _take_token(self, domain, state, deadline):
+        """Reserves the domain's next request, and sleeps until it's due."""
+        with self._lock:
+            now = time.monotonic()
+            if state.delay > 0:
+                state.tokens = min(1.0, state.tokens + (now - state.updated) / state.delay)
+            else:
+                state.tokens = 1.0
+            state.updated = now
+            pause = (1.0 - state.tokens) * state.delay
+            if now + pause > deadline:
+                raise DomainBusyError(f"{domain} is being paced at one request every {state.delay:.1f}s")
+            state.tokens -= 1.0  # May go below 0: the threads queued behind us wait longer
+        if pause > 0:
+            time.sleep(pause)
+
+    def report(self, domain, status_code):
+        """
+        Adjusts the domain's delay to the HTTP status of its latest answer.
+
+        Attributes:
+            domain (str): A domain, as returned by `miners.domain_of`.
+            status_code (int): The page's HTTP status, or None if unknown.
+        """
+        if status_code is None:
+            return
+        state = self._domain(domain)
+        with self._lock:
+            if status_code in self.THROTTLE_STATUSES:
+                state.delay = min(self.max_delay, max(2 * state.delay, self.min_delay, 0.1))
+            else:
+                step = (self.max_delay - self.min_delay) / 10
+                state.delay = max(self.min_delay, state.delay - step)
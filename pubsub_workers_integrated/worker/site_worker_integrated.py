@@ -1,17 +1,30 @@
 import json
-from tld import get_fld
+import time
+from os import environ
 from datetime import datetime, date
 
-from miners import ArxivMiner
-from miners import BiorxivMiner
-from miners import IbmcRuMiner
-from miners import MedrxivMiner
-from miners import PreprintsMiner
-from miners import ScieloMiner
+from tables import DataTable
+from scheduling import DomainBusyError
+from metrics import metrics
+from logs import logger, log_sampled
+import miners
+
 
 class MinerNotFoundError(Exception):
     pass
 
+class PageNotFoundError(Exception):
+    pass
+
+# Data table columns filled from a location with another name
+COLUMN_LOCATIONS = {"publication_date": "date_publication"}
+# Locations saved in the data table's meta_info column
+META_INFO_LOCATIONS = ("references", "search_keyword", "license", "extra_link",
+                       "title_translated", "abstract_translated")
+# Locations needed to build a data table row (see SiteWorkerIntegrated.scrape_data)
+STORED_LOCATIONS = frozenset(
+    [COLUMN_LOCATIONS.get(field.name, field.name) for field in DataTable.schema] + list(META_INFO_LOCATIONS))
+
 class SiteWorkerIntegrated:
     """
     SiteWorkerIntegrated class uses `site_worker_factory` method
@@ -20,33 +33,155 @@ class SiteWorkerIntegrated:
 
     Attributes:
         driver_path(str): A path to a chromium webdriver. Default is None
+        browser_pool (BrowserPool): Warm browser sessions to mine with. Default
+                                    is None, which starts a new browser
+                                    for each article.
+        scheduler (DomainScheduler): Paces and caps the requests to each
+                                     domain across threads (see its min_delay
+                                     and max_delay). Default is None.
         max_threshold (int): A default value of how many articles to upload
                           to a BigQuery table at a time.
-        min_delay (int): A default value of min seconds to wait before the
-                      next request to a website is sent.
-        max_delay (int): A default value of max seconds to wait before the
-                      next request to a website is sent.
+        status_code (int): HTTP status of the last page scraped, if known.
+        budget (float): Seconds the scraping may take, counted from when the
+                        domain's slot and a browser are held. Default is
+                        None (no time budget).
+        deadline (float): time.monotonic() by which the scraping should be
+                          done, set from budget once it starts.
+        skipped_fields (list): Optional locations left out of the last page
+                               scraped, because the deadline had passed.
+        on_start (callable): Called without arguments once the domain's slot
+                             and a browser are held, right before the page
+                             is loaded. Default is None.
+        extract_all_fields (bool): If True, miners gather every location of
+                                   their site, and the ones without a column
+                                   are saved in meta_info. By default only
+                                   STORED_LOCATIONS are gathered. Set with
+                                   the EXTRACT_ALL_FIELDS environment variable.
     """
-    def __init__(self, driver_path=None):
+    extract_all_fields = environ.get("EXTRACT_ALL_FIELDS", "0") == "1"
+
+    def __init__(self, driver_path=None, browser_pool=None, scheduler=None):
         self.driver_path = driver_path
+        self.browser_pool = browser_pool
+        self.scheduler = scheduler
         self.max_threshold = 50
-        self.min_delay = 0.1
-        self.max_delay = 2
+        self.status_code = None
+        self.budget = None
+        self.deadline = None
+        self.skipped_fields = []
+        self.on_start = None
 
-    def send_request(self, url):
+    def send_request(self, url, budget=None, on_start=None):
         """
         Finds domain from urls dataframe and sends request
         to a domain-specific SiteWorker using site_worker_factory class method.
 
         Attributes:
             url (str): An article url.
+            budget (float): Seconds the scraping may take once it starts.
+                            Default is None.
+            on_start (callable): Called once the scraping actually starts,
+                                 i.e. not if the domain is too busy to take
+                                 the article. Default is None.
 
         Returns:
             (dictionary): Scraped data in form of a dictionary.
+
+        Raises:
+            DomainBusyError: If the domain is busy, or answered that we're
+                             sending it too many requests.
+            PageNotFoundError: If the page doesn't exist (404 or 410).
+                               Both are raised from the page's status even
+                               if the miner failed on the error page.
+            BudgetExceededError: If the page couldn't be loaded within
+                                 the budget.
+        """
+        domain = miners.domain_of(url)
+        site_worker = self.site_worker_factory(domain, url, self.driver_path, self.browser_pool)
+        site_worker.budget = budget
+        site_worker.on_start = on_start
+        site_worker.scheduler = self.scheduler
+        try:
+            data = site_worker.scrape_articles()
+        except Exception:
+            # Error pages usually make the miner fail before it's done: what the site answered says more
+            self.raise_for_status(url, domain, site_worker.status_code)
+            raise
+        finally:
+            self.skipped_fields = site_worker.skipped_fields
+        self.raise_for_status(url, domain, site_worker.status_code)
+        return data
+
+    def raise_for_status(self, url, domain, status_code):
+        """
+        Raises the error the HTTP status of a page stands for, if any.
+
+        Attributes:
+            url (str): An article url.
+            domain (str): The url's domain.
+            status_code (int): The page's HTTP status, or None if unknown.
+
+        Raises:
+            DomainBusyError: If the status is one the scheduler throttles on.
+            PageNotFoundError: If the status is 404 or 410.
+        """
+        if self.scheduler is not None and status_code in self.scheduler.THROTTLE_STATUSES:
+            raise DomainBusyError(f"{domain} answered {status_code}, slowing down")
+        if status_code in (404, 410):
+            raise PageNotFoundError(f"{url} answered {status_code}")
+
+    def mine(self, engine, locations):
+        """
+        Scrapes self.url with the given miner, on a browser leased from
+        self.browser_pool, or on a browser of its own if there's no pool.
+        Miners that don't use a browser fetch the page over HTTP instead.
+        The domain's slot in self.scheduler is taken once the browser is
+        held.
+
+        Attributes:
+            engine (BaseEngine): A miner's engine class.
+            locations (centaurminer.PageLocations): A miner's locations class.
+
+        Returns:
+            data(dictionary): Scraped data in form of dictionary.
         """
-        domain = get_fld(url)
-        site_worker = self.site_worker_factory(domain, url, self.driver_path)
-        return site_worker.scrape_articles()
+        fields = None if self.extract_all_fields else STORED_LOCATIONS
+        if not engine.use_browser:
+            return self._scrape(engine(locations, fields=fields))
+        if self.browser_pool is None:
+            miner = engine(locations, driver_path=self.driver_path, fields=fields)
+            try:
+                return self._scrape(miner)
+            finally:
+                miner.close()
+        start = time.perf_counter()
+        with self.browser_pool.lease() as wd:
+            metrics.observe("browser_lease_seconds", time.perf_counter() - start)
+            return self._scrape(engine(locations, wd=wd, fields=fields))
+
+    def _scrape(self, miner):
+        if self.scheduler is None:
+            return self._run(miner)
+        # Only taken once the browser is held: a thread waiting for one doesn't tie up the domain's slot,
+        # nor take a token for a request that would go out whenever a browser frees up
+        domain = miners.domain_of(self.url)
+        with self.scheduler.slot(domain):
+            try:
+                return self._run(miner)
+            finally:
+                self.scheduler.report(domain, miner.status_code)
+
+    def _run(self, miner):
+        # The slot and browser are held now: waiting for them doesn't count against the budget
+        if self.budget is not None:
+            self.deadline = miner.deadline = time.monotonic() + self.budget
+        if self.on_start is not None:
+            self.on_start()
+        try:
+            return self.scrape_data(miner, self.url)
+        finally:
+            self.status_code = miner.status_code
+            self.skipped_fields = miner.skipped
 
     @staticmethod
     def scrape_data(miner, url):
@@ -63,7 +198,23 @@ class SiteWorkerIntegrated:
             data(dictionary): Scraped data in form of dictionary.
         """
         miner.gather(url)
-        print(miner.results)
+        # Whole articles are too much to log every time: log a sample of them, without the long texts
+        log_sampled("Results for %s: %s", url, {field: value[:200] + "..." if isinstance(value, str) and len(value) > 200 else value
+                                                for field, value in miner.results.items()})
+
+        domain = miners.domain_of(url, fail_silently=True)
+        for stage, seconds in miner.timings.items():
+            metrics.observe(f"page_{stage}_seconds", seconds, domain=domain)
+        for field, seconds in miner.field_timings.items():
+            metrics.observe("field_seconds", seconds, domain=domain, field=field)
+
+        # Show where the time went, slowest fields first
+        slowest = sorted(miner.field_timings.items(), key=lambda item: item[1], reverse=True)[:5]
+        logger.info(f"Timings for {url}: "
+                    + ", ".join(f"{stage} {seconds:.2f}s" for stage, seconds in miner.timings.items())
+                    + " | slowest fields: "
+                    + ", ".join(f"{field} {seconds:.2f}s" + ("" if miner.results.get(field) else " (missing)")
+                                for field, seconds in slowest))
 
         time = datetime.min.time()
         data = {
@@ -95,154 +246,53 @@ class SiteWorkerIntegrated:
         if miner.results.get('abstract_translated'):
             meta_info['abstract_translated'] = miner.results['abstract_translated']
 
+        # Fields left out because the time budget ran out
+        if miner.skipped:
+            meta_info['skipped_fields'] = miner.skipped
+
+        # Everything else the miner gathered, when it wasn't limited to the stored locations
+        if miner.fields is None:
+            for field, value in miner.results.items():
+                if field not in STORED_LOCATIONS and field not in ('url', 'date_aquisition') and value:
+                    meta_info[field] = value
+
         data['meta_info'] = json.dumps(meta_info, ensure_ascii=False)
         return data
 
     @classmethod
-    def site_worker_factory(cls, domain_name, url, driver_path=None):
+    def site_worker_factory(cls, domain_name, url, driver_path=None, browser_pool=None):
         """ Sends a scraping request to a domain-specific SiteWorker
 
+        The domain's miner comes from the registry in the miners package,
+        which only imports a miner's module once its first article is mined.
+
         Attributes:
             domain_name (str): A domain.
             url (str): An article url.
             driver_path (str): A driver path to a chromium-chromedriver.
+            browser_pool (BrowserPool): Warm browser sessions to mine with.
         """
-        site_worker = {'ibmc.msk.ru': IbmcRuSiteWorker(url, driver_path),
-                       'arxiv.org': ArxivSiteWorker(url, driver_path),
-                       'biorxiv.org': BiorxivSiteWorker(url, driver_path),
-                       'medrxiv.org': MedrxivSiteWorker(url, driver_path),
-                       'scielo.br': ScieloSiteWorker(url, driver_path),
-                       'sld.cu': ScieloSiteWorker(url, driver_path),
-                       'preprints.org': PreprintsSiteWorker(url, driver_path)
-                       }
         try:
-            return site_worker[domain_name]
+            miner = miners.get(domain_name)
         except KeyError as e:
             raise MinerNotFoundError(f"The miner you requested ({domain_name}) does not exist")
+        return SiteWorker(miner, url, driver_path, browser_pool)
 
 
-""" Site Workers """
-""" Define IbmcRuSiteWorker class """
-
-
-class IbmcRuSiteWorker(SiteWorkerIntegrated):
-    """
-    SiteWorker for http://pbmc.ibmc.msk.ru/
-
-    Attributes:
-       url (str): An article url.
-       driver_path (str): A driver path to a chromium-chromedriver. Default is None.
-    """
-    def __init__(self, url, driver_path=None):
-        super().__init__()
-        self.url = url
-        self.driver_path = driver_path
-
-    def scrape_articles(self):
-        miner = IbmcRuMiner.IbmcEngine(IbmcRuMiner.IbmcLocations, driver_path=self.driver_path)
-        return self.scrape_data(miner, self.url)
-
-
-""" Define ArxivSiteWorker class """
-
-
-class ArxivSiteWorker(SiteWorkerIntegrated):
+class SiteWorker(SiteWorkerIntegrated):
     """
-    SiteWorker for https://arxiv.org/
-
-    Attributes:
-        url (str): An article url.
-        driver_path (str): A driver path to a chromium-chromedriver. DEfault is None.
-    """
-    def __init__(self, url, driver_path=None):
-        super().__init__()
-        self.url = url
-        self.driver_path = driver_path
-
-    def scrape_articles(self):
-        miner = ArxivMiner.ArxivEngine(ArxivMiner.ArxivLocations, driver_path=self.driver_path)
-        return self.scrape_data(miner, self.url)
-
-
-""" Define BiorxivSiteWorker class """
-
-
-class BiorxivSiteWorker(SiteWorkerIntegrated):
-    """
-    SiteWorker for https://www.biorxiv.org/
-
-    Attributes:
-        url (str): An article url.
-        driver_path (str): A driver path to a chromium-chromedriver. Default is None.
-    """
-    def __init__(self, url, driver_path=None):
-        super().__init__()
-        self.url = url
-        self.driver_path = driver_path
-
-    def scrape_articles(self):
-        miner = BiorxivMiner.BiorxivEngine(BiorxivMiner.BiorxivLocations, driver_path=self.driver_path)
-        return self.scrape_data(miner, self.url)
-
-
-""" Define MedrxivSiteWorker class """
-
-
-class MedrxivSiteWorker(SiteWorkerIntegrated):
-    """
-    SiteWorker for https://www.medrxiv.org/
+    SiteWorker for the articles of one site, mined with the site's miner.
 
     Attributes:
+        miner (type): The site's miner, from the registry in the miners package.
         url (str): An article url.
         driver_path (str): A driver path to a chromium-chromedriver. Default is None.
+        browser_pool (BrowserPool): Warm browser sessions to mine with. Default is None.
     """
-    def __init__(self, url, driver_path=None):
-        super().__init__()
+    def __init__(self, miner, url, driver_path=None, browser_pool=None):
+        super().__init__(driver_path, browser_pool)
+        self.miner = miner
         self.url = url
-        self.driver_path = driver_path
-  
-    def scrape_articles(self):
-        miner = MedrxivMiner.MedrxivEngine(MedrxivMiner.MedrxivLocations, driver_path=self.driver_path)
-        return self.scrape_data(miner, self.url)
-
-
-""" Define ScieloSiteWorker class """
-
-
-class ScieloSiteWorker(SiteWorkerIntegrated):
-    """
-    SiteWorker for https://www.scielo.org/
-
-    Attributes:
-        url (str): An article url.
-        driver_path (str): A driver path to a chromium-chromedriver. Default is None.
-    """
-    def __init__(self, url, driver_path=None):
-        super().__init__()
-        self.url = url
-        self.driver_path = driver_path
-  
-    def scrape_articles(self):
-        miner = ScieloMiner.ScieloEngine(ScieloMiner.ScieloLocations, driver_path=self.driver_path)
-        return self.scrape_data(miner, self.url)
-
-
-""" Define PreprintsSiteWorker class """
-
-
-class PreprintsSiteWorker(SiteWorkerIntegrated):
-    """
-    SiteWorker for http://preprints.org/
-
-    Attributes:
-        url (str): An article url.
-        driver_path (str): A driver path to a chromium-chromedriver. Default is None.
-    """
-    def __init__(self, url, driver_path=None):
-        super().__init__()
-        self.url = url
-        self.driver_path = driver_path
 
     def scrape_articles(self):
-        miner = PreprintsMiner.PreprintsEngine(PreprintsMiner.PreprintsLocations, driver_path=self.driver_path)
-        return self.scrape_data(miner, self.url)
+        return self.mine(self.miner.engine, self.miner.locations)
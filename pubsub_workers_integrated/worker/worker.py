@@ -1,100 +1,320 @@
 #!/usr/bin/env python
 
 import json
-import tldextract
+import time
+import logging
+import random
+import threading
 from datetime import datetime, timezone
 from google.cloud import pubsub_v1
-from tables import StatusTable, DataTable
-from site_worker_integrated import SiteWorkerIntegrated, MinerNotFoundError
+from tables import StatusTable, DataTable, on_flushed
+from tables.ledger import UrlLedger, normalize_url
+from site_worker_integrated import SiteWorkerIntegrated, MinerNotFoundError, PageNotFoundError
+from metrics import metrics
+import miners
+from browser_pool import BrowserPool
+from scheduling import DomainScheduler, DomainBusyError
+from concurrent.futures import ThreadPoolExecutor
+from google.cloud.pubsub_v1.subscriber.scheduler import ThreadScheduler
 from selenium.common.exceptions import WebDriverException
-from google.cloud import logging
+from requests import RequestException
+from logs import setup_logging
 from os import environ
 
-logging_client = logging.Client()
 worker_name = environ.get("MINER_ID")
-logger = logging_client.logger(worker_name)
+# Log records are shipped to google cloud logging in batches, from a background thread
+logger = setup_logging(worker_name,
+                       log_file=environ.get('LOG_FILE'),
+                       max_chars=int(environ.get('LOG_MAX_CHARS', '2000')),
+                       sample_rate=float(environ.get('LOG_SAMPLE_RATE', '0.01')))
 
+# With TABLE_CACHE_PATH set, the tables' metadata is read from disk after the first run, and the bigquery
+# client is only created when the first rows are written
 statusTable = StatusTable().GetOrCreate()
 dataTable = DataTable().GetOrCreate()
 
+# Rows are streamed to bigquery in batches; messages are acked once their rows are flushed
+flush_seconds = float(environ.get('BQ_FLUSH_SECONDS', '5'))
+statusWriter = statusTable.batch_writer(max_age=flush_seconds)
+dataWriter = dataTable.batch_writer(max_age=flush_seconds)
+
+# Warm browser sessions shared by every message, started in __main__
+browser_pool = None
+# Paces each site between MIN_DELAY and MAX_DELAY seconds per request, depending on how it copes
+domain_scheduler = DomainScheduler(int(environ.get('MAX_PER_DOMAIN', '0')),
+                                   min_delay=float(environ.get('MIN_DELAY', '0.1')),
+                                   max_delay=float(environ.get('MAX_DELAY', '2')))
+
+# Seconds a message may take to mine, once its site's slot and a browser are held. Past that, optional fields
+# are skipped and what was gathered is stored; a page that isn't even loaded by then fails
+message_budget = float(environ.get('MESSAGE_BUDGET_SECONDS', '120'))
+
+# Failed messages come back after a backoff doubling from RETRY_MIN_BACKOFF up to RETRY_MAX_BACKOFF seconds,
+# until their MAX_DELIVERY_ATTEMPTS-th delivery (the subscription's setting), which goes to the dead letter topic
+retry_min_backoff = int(environ.get('RETRY_MIN_BACKOFF', '10'))
+retry_max_backoff = int(environ.get('RETRY_MAX_BACKOFF', '600'))
+max_delivery_attempts = int(environ.get('MAX_DELIVERY_ATTEMPTS', '5'))
+
+# Messages bounced because their site is busy are published again after about BUSY_REQUEUE_SECONDS
+busy_requeue = float(environ.get('BUSY_REQUEUE_SECONDS', '10'))
+# Publishes the bounced messages again, set in __main__
+publisher = None
+topic_path = None
+
+# Articles this worker already mined and stored, so redelivered messages for them are just acked
+finished = UrlLedger(environ.get('FINISHED_LEDGER_PATH', 'finished.sqlite'),
+                     ttl=float(environ.get('FINISHED_TTL_HOURS', '168')) * 3600)
+# Messages for articles being mined right now, by url: duplicates wait for the first one's outcome
+in_flight = {}
+in_flight_lock = threading.Lock()
+
 def LogToGCP(text):
     '''
     Log a message using google cloud logging, with the VM name at the beginning.
+
+    The message is only queued here; it's sent with others from a background thread.
+    '''
+    logger.info(text)
+
+
+def settle(message, pending, key, outcome, started, ack=True, mined=False, requeued=False):
+    '''
+    Acks (or retries) the message once the bigquery rows written for it are flushed.
+
+    If any of those rows couldn't be written, the message is retried instead, so it's mined again.
+    With requeued=True, the message wasn't mined for lack of capacity, and is requeued instead of retried.
+    The duplicates of the message that arrived meanwhile are settled the same way, and if the article
+    was mined, it's remembered as finished. The outcome (usually the last status) and the time since
+    `started` (time.monotonic()) go to the metrics.
+    '''
+    flushing = time.monotonic()
+
+    def done(errors):
+        if errors != []:
+            LogToGCP(f"We've got some errors when updating bq: {errors}")
+        ok = errors == [] and ack
+        requeue_them = errors == [] and requeued
+        now = time.monotonic()
+        if pending:
+            metrics.observe("bigquery_flush_seconds", now - flushing)
+        metrics.observe("message_seconds", now - started, outcome=outcome)
+        metrics.inc("messages_total", domain=miners.domain_of(key, fail_silently=True), outcome=outcome,
+                    result="acked" if ok else "requeued" if requeue_them else "retried")
+        if ok and mined:
+            finished.add(key)
+        for msg in [message] + release(key):
+            if ok:
+                msg.ack()
+            elif requeue_them:
+                requeue(msg)
+            else:
+                retry(msg)
+    on_flushed(pending, done)
+
+
+def last_attempt(message):
+    '''
+    Tells if the message won't be delivered again if it fails, but sent to the dead letter topic.
+    '''
+    return message.delivery_attempt is not None and message.delivery_attempt >= max_delivery_attempts
+
+
+def retry(message):
+    '''
+    Hands the message back to pubsub to be mined again later, instead of right away like nack() does.
+
+    The message's ack deadline is set to a backoff that doubles with each delivery attempt (with jitter),
+    and the message is dropped from lease management, so pubsub delivers it again once the deadline is
+    up. On the last attempt, it's nacked so it goes to the dead letter topic right away.
+    '''
+    if last_attempt(message):
+        message.nack()
+        return
+    attempt = message.delivery_attempt or 1
+    backoff = min(retry_max_backoff, retry_min_backoff * 2 ** (attempt - 1))
+    backoff = random.uniform(backoff / 2, backoff)
+    message.modify_ack_deadline(max(10, min(600, int(backoff))))  # Pub/Sub's bounds
+    message.drop()
+
+
+def requeue(message):
+    '''
+    Hands a message that wasn't mined for lack of capacity (a busy or throttling site) back to the queue.
+
+    This isn't a failure, so it neither waits for the failure backoff nor uses up a delivery attempt:
+    after a short jittered delay, the message is published again as a new one (with a `bounces` count
+    attribute), and the original is acked. If it can't be published, it's handed back with a short ack
+    deadline instead.
+    '''
+    bounces = int(message.attributes.get('bounces', '0')) + 1
+
+    def fallback():
+        message.modify_ack_deadline(max(10, int(busy_requeue)))
+        message.drop()
+
+    def published(future):
+        if future.exception() is None:
+            message.ack()
+        else:
+            fallback()
+
+    def republish():
+        try:
+            publisher.publish(topic_path, message.data, bounces=str(bounces)).add_done_callback(published)
+        except Exception:
+            fallback()
+
+    if publisher is None:
+        fallback()
+        return
+    timer = threading.Timer(random.uniform(busy_requeue / 2, busy_requeue), republish)
+    timer.daemon = True
+    timer.start()
+
+
+def failed(message, status, reason, error, permanent=False):
+    '''
+    Sets the failure status, with the delivery attempt and error in its meta_info.
+
+    Transient failures on the last attempt are also flagged as dead lettered.
+    '''
+    try:
+        meta_info = json.loads(status.get('meta_info') or '{}')
+    except ValueError:
+        meta_info = {}
+    meta_info['attempt'] = message.delivery_attempt
+    meta_info['error'] = str(error)
+    if not permanent and last_attempt(message):
+        meta_info['dead_lettered'] = True
+    status['status'] = reason
+    status['timestamp'] = datetime.now(timezone.utc)
+    status['meta_info'] = json.dumps(meta_info)
+    return status
+
+
+def release(key):
     '''
-    global logger, worker_name
-    logger.log_text(worker_name + ": " + text)
+    Marks the article as no longer being mined, and returns the duplicate messages that waited on it.
+    '''
+    with in_flight_lock:
+        return in_flight.pop(key, [])
+
+
+def already_finished(message, status, key):
+    '''
+    Tells if the article was mined and stored already - by this worker, or for redelivered (or reaped) messages, by anyone.
+    '''
+    url = status['article_url']
+    if key in finished:
+        return True
+    # delivery_attempt is only set on subscriptions with a dead letter topic; without one, always check.
+    # Reaped urls are published again as new messages, so their first delivery may well be a duplicate
+    reaped = '"reaped"' in (status.get('meta_info') or '')
+    if message.delivery_attempt is not None and message.delivery_attempt <= 1 and not reaped:
+        return False
+    try:
+        done = statusTable.IsFinished(url)
+    except Exception as e:  # Can't tell - mine it again rather than drop it
+        LogToGCP(f"Couldn't check if {url} was already mined: {e}")
+        return False
+    if done:
+        finished.add(key)
+    return done
 
 
 def callback(message):
     LogToGCP(f"\n [x] Received {message.data.decode('utf-8')}")
-    LogToGCP("Delivery attempt number: " + message.delivery_attempt)
+    LogToGCP(f"Delivery attempt number: {message.delivery_attempt}")
     status = json.loads(message.data.decode("utf-8"))
+    key = normalize_url(status['article_url'])
+    metrics.observe("queue_wait_seconds", (datetime.now(timezone.utc) - message.publish_time).total_seconds())
 
-    # Tell bq that we received the request
-    status['status'] = 'Started Mining'
-    status['timestamp'] = datetime.now(timezone.utc)
-    status['worker_id'] = worker_name
-    errors = statusTable.insert_row(status)
-    if errors != []:
-        LogToGCP(f"We've got some errors when updating bq: {errors}")
-        message.nack()
+    with in_flight_lock:
+        if key in in_flight:
+            LogToGCP(f"{status['article_url']} is already being mined, waiting for it to finish")
+            in_flight[key].append(message)
+            return
+        in_flight[key] = []
+
+    # Not raised: the subscriber would nack the message, undoing the retry's backoff, and stop
+    try:
+        mine(message, status, key)
+    except Exception:
+        logger.exception(f"Mining {status['article_url']} crashed")
+        for msg in [message] + release(key):
+            retry(msg)
+
+
+def mine(message, status, key):
+    started = time.monotonic()
+    if already_finished(message, status, key):
+        LogToGCP(f"{status['article_url']} was already mined, skipping it")
+        settle(message, [], key, 'Already mined', started)
         return
 
+    pending = []  # bigquery rows that have to be flushed before acking
+    status['worker_id'] = worker_name
+
+    def start():
+        # Tell bq that we received the request, once the site has room for it
+        status['status'] = 'Started Mining'
+        status['timestamp'] = datetime.now(timezone.utc)
+        pending.append(statusWriter.add(status))
+
     # Do the actual mining
     LogToGCP("Getting article info from " + status['article_url'])
     try:
-        data = SiteWorkerIntegrated().send_request(status['article_url'])
-    except MinerNotFoundError as e:
-        LogToGCP("Mining failed: " + e)
-        status['status'] = 'Failed - No miner'
-        status['timestamp'] = datetime.now(timezone.utc)
-        errors = statusTable.insert_row(status)
-        message.nack()
-        if errors != []:
-            LogToGCP(f"We've got some errors when updating bq: {errors}")
+        site_worker = SiteWorkerIntegrated(browser_pool=browser_pool, scheduler=domain_scheduler)
+        data = site_worker.send_request(status['article_url'], message_budget, on_start=start)
+    except DomainBusyError as e:  # Let another worker (or this one, later) take it
+        LogToGCP(str(e))
+        if pending:  # The site throttled us once we'd started: the url is back in the queue
+            status['status'] = 'Sent to queue'
+            status['timestamp'] = datetime.now(timezone.utc)
+            pending.append(statusWriter.add(status))
+        settle(message, pending, key, 'Domain busy', started, ack=False, requeued=True)
+        return
+    except (MinerNotFoundError, PageNotFoundError) as e:  # Permanent: mining it again won't help
+        LogToGCP(f"Mining failed: {e}")
+        reason = 'Failed - No miner' if isinstance(e, MinerNotFoundError) else 'Failed - Not found'
+        pending.append(statusWriter.add(failed(message, status, reason, e, permanent=True)))
+        settle(message, pending, key, reason, started)
         return
     except WebDriverException as e:  # Handle webdriver timeouts
-        LogToGCP(e)
-        status['status'] = 'Failed - Timeout'
-        status['timestamp'] = datetime.now(timezone.utc)
-        errors = statusTable.insert_row(status)
-        message.nack()
-        if errors != []:
-            LogToGCP(f"We've got some errors when updating bq: {errors}")
+        LogToGCP(f"Mining failed: {e}")
+        pending.append(statusWriter.add(failed(message, status, 'Failed - Timeout', e)))
+        settle(message, pending, key, status['status'], started, ack=False)
+        return
+    except RequestException as e:  # Pages fetched without a browser: network errors and server failures
+        LogToGCP(f"Mining failed: {e}")
+        pending.append(statusWriter.add(failed(message, status, 'Failed - Network', e)))
+        settle(message, pending, key, status['status'], started, ack=False)
         return
-        
-        
+
     if data is None:
         LogToGCP("Mining returned no results.")
         status['status'] = "Failed - No results"
         status['timestamp'] = datetime.now(timezone.utc)
-        errors = statusTable.insert_row(status)
-        if errors != []:
-            LogToGCP(f"We've got some errors when updating bq: {errors}")
-            message.nack()
-            return
-        message.ack()
+        pending.append(statusWriter.add(status))
+        settle(message, pending, key, status['status'], started)
         return
     if not data.get('language'):
         data['language'] = status['language']  # Should always be true...
 
     # Send results to the data table
-    errors = dataTable.insert_row(data)
-    if errors != []:
-        LogToGCP(f"We've got some errors when updating bq: {errors}")
+    pending.append(dataWriter.add(data))
 
     # Send an update to bq that we're done
     status['status'] = 'Finished Mining'
+    if site_worker.skipped_fields:
+        LogToGCP(f"Out of time, skipped {', '.join(site_worker.skipped_fields)}")
+        status['status'] = 'Finished Mining - Partial'
     status['timestamp'] = datetime.now(timezone.utc)
-    errors = statusTable.insert_row(status)
-    if errors != []:
-        LogToGCP(f"We've got some errors when updating bq: {errors}")
-        message.nack()
-        return
+    pending.append(statusWriter.add(status))
 
     LogToGCP(" [x] Done")
     LogToGCP(' [*] Waiting for messages.')
-    message.ack()
+    settle(message, pending, key, status['status'], started, mined=True)
 
 
 if __name__ == "__main__":
@@ -106,20 +326,60 @@ if __name__ == "__main__":
 
     assert project_id is not None, "Include a .env file using the docker argument --env-file when running."
 
+    # The browsers start in the background while we subscribe: messages for miners that don't
+    # need a browser are mined right away, the others wait for the first free browser
+    pool_size = int(environ.get('BROWSER_POOL_SIZE', '1'))
+    # Each browser is replaced after BROWSER_MAX_PAGES articles, or once it uses over BROWSER_MAX_RSS_MB MB
+    max_pages = int(environ.get('BROWSER_MAX_PAGES', '200'))
+    max_rss_mb = float(environ.get('BROWSER_MAX_RSS_MB', '1024'))
+    browser_pool = BrowserPool(pool_size, background=True, max_pages=max_pages or None, max_rss_mb=max_rss_mb or None)
+
+    # Mine up to MAX_MESSAGES articles at once, one thread each. Threads rather than
+    # processes: each thread spends its time waiting on its own Chrome process.
+    max_messages = int(environ.get('MAX_MESSAGES', pool_size))
+
+    # Latency histograms and counters, served for Prometheus at :METRICS_PORT/metrics and logged every
+    # METRICS_SUMMARY_SECONDS
+    metrics_port = int(environ.get('METRICS_PORT', '9100'))
+    if metrics_port:
+        metrics.serve(metrics_port)
+    summary_seconds = float(environ.get('METRICS_SUMMARY_SECONDS', '300'))
+    if summary_seconds > 0:
+        metrics.report_every(summary_seconds, LogToGCP)
+
+    # The finished ledger only hides the urls older than its ttl: delete them every hour, so it doesn't keep growing
+    stop_purging = threading.Event()
+
+    def purge_finished():
+        while not stop_purging.wait(3600):
+            finished.purge()
+    threading.Thread(target=purge_finished, name="ledger-purge", daemon=True).start()
+
     LogToGCP(f"Miner started at {datetime.now().strftime('%d/%m/%y: %H:%M:%S')}.")
     LogToGCP(' [*] Waiting for messages.')
 
+    # Busy sites' messages are published again to the topic
+    publisher = pubsub_v1.PublisherClient()
+    topic_path = publisher.topic_path(project_id, environ.get('PUBSUB_TOPIC'))
+
     # Create a subscriber
     subscriber = pubsub_v1.SubscriberClient()
     subscription_path = subscriber.subscription_path(project_id, subcription_ID)
 
-    flow_control = pubsub_v1.types.FlowControl(max_messages=1)
+    # Leave room for as many messages again waiting on their bigquery rows to be flushed.
+    # The client keeps extending the leases of the messages it holds, for up to MAX_LEASE_SECONDS (an hour,
+    # as the client's own default), so messages still waiting for a browser or their site's slot, or being
+    # mined, aren't redelivered to another worker. It's never less than the site's wait plus the budget.
+    max_lease = max(int(environ.get('MAX_LEASE_SECONDS', '3600')), int(domain_scheduler.wait + message_budget) + 60)
+    flow_control = pubsub_v1.types.FlowControl(max_messages=2 * max_messages, max_lease_duration=max_lease)
+    executor = ThreadPoolExecutor(max_workers=max_messages, thread_name_prefix="miner")
 
     # Subscribe
     streaming_pull_future = subscriber.subscribe(
         subscription_path,
         callback=callback,
-        flow_control=flow_control
+        flow_control=flow_control,
+        scheduler=ThreadScheduler(executor=executor)
     )
     LogToGCP(f"Listening for messages on {subscription_path}")
     print(f"Listening for messages on {subscription_path}. Go to google logging to see status.")
@@ -128,5 +388,12 @@ if __name__ == "__main__":
     try:
         streaming_pull_future.result()
     except Exception as e:
-        LogToGCP(e)
+        LogToGCP(str(e))
         streaming_pull_future.cancel()
+    finally:
+        browser_pool.close()
+        statusWriter.close()
+        dataWriter.close()
+        stop_purging.set()
+        finished.close()
+        logging.shutdown()  # Sends the queued log records
@@ -7,6 +7,7 @@ from datetime import datetime
 from os import environ
 from google.cloud import bigquery
 from tables import StatusTable
+from tables.ledger import UrlLedger
 
 # extract environment variables
 mq_user = environ.get('RABBIT_USERNAME')
@@ -14,55 +15,111 @@ mq_pass = environ.get('RABBIT_PASSWORD')
 host_ip = environ.get('RABBIT_HOST_IP')
 
 DELAY = int(environ.get('DELAY'))
+# Messages published per transaction (and status rows per bigquery insert)
+BATCH_SIZE = int(environ.get('BATCH_SIZE', '500'))
+# Urls published in the last LEDGER_TTL_HOURS aren't published again, even if they still look 'Not Mined'
+LEDGER_PATH = environ.get('LEDGER_PATH', 'dispatched.sqlite')
+LEDGER_TTL_HOURS = float(environ.get('LEDGER_TTL_HOURS', '6'))
 
 assert None not in [mq_user, mq_pass, host_ip], "Include a .env file using the docker argument --env-file when running."
 
 credentials = pika.PlainCredentials(mq_user, mq_pass)
 
 
+def connect():
+    '''
+    Opens the connection and channel used for every batch, and declares the queue once.
+
+    The channel is transactional: a batch is confirmed by the broker with a single tx_commit,
+    instead of waiting for a confirm after every message.
+    '''
+    connection = pika.BlockingConnection(
+        pika.ConnectionParameters(host=host_ip, credentials=credentials))
+    channel = connection.channel()
+    channel.queue_declare(queue='task_queue', durable=True)
+    channel.tx_select()
+    return connection, channel
+
+
+def close(connection):
+    try:
+        if connection is not None and connection.is_open:
+            connection.close()
+    except pika.exceptions.AMQPError:
+        pass
+
+
+def publish(channel, rows):
+    '''
+    Publishes a batch of rows in one transaction. Either all of them are in the queue once this returns, or none.
+    '''
+    for row in rows:
+        channel.basic_publish(
+            exchange='',
+            routing_key='task_queue',
+            body=json.dumps(row),
+            properties=pika.BasicProperties(
+                delivery_mode=2,  # make message persistent
+            ))
+    channel.tx_commit()
+
+
 statusTable = StatusTable().GetOrCreate()
+ledger = UrlLedger(LEDGER_PATH, ttl=LEDGER_TTL_HOURS * 3600)
+connection, channel = None, None
 
 # Start the listening loop
 try:
     while True:  # Use sigint to break the loop
-        newData = statusTable.GetNewURLs()
-
-        if len(newData):
-            # Send data from BQ to rabbitMQ
-            connection = pika.BlockingConnection(
-                pika.ConnectionParameters(host=host_ip, credentials=credentials))
-            channel = connection.channel()
-            channel.queue_declare(queue='task_queue', durable=True)
-            for row in newData:
-                # Remove extra data that doesn't need to be sent
-                row.pop('timestamp')
-                row.pop('status')
-
-                request = json.dumps(row)
-
-                # Send the data through to the rabbitMQ queue
-                channel.basic_publish(
-                    exchange='',
-                    routing_key='task_queue',
-                    body=request,
-                    properties=pika.BasicProperties(
-                        delivery_mode=2,  # make message persistent
-                    ))
-                print(f" [x] Sent {request}", flush=True)
-
-                # Update the input row with a new timestamp and status, and add a row to the bq table
+        ledger.purge()
+        newData = [row for row in statusTable.GetNewURLs() if row['article_url'] not in ledger]
+        sent = 0
+
+        for row in newData:
+            # Remove extra data that doesn't need to be sent
+            row.pop('timestamp')
+            row.pop('status')
+
+        for start in range(0, len(newData), BATCH_SIZE):
+            batch = newData[start:start + BATCH_SIZE]
+
+            # Send the batch through to the rabbitMQ queue, reconnecting if the connection was lost
+            try:
+                if connection is None or not connection.is_open:
+                    connection, channel = connect()
+                publish(channel, batch)
+            except pika.exceptions.AMQPError as e:
+                print(f"Couldn't publish to rabbitMQ, will retry next loop: {e!r}", flush=True)
+                close(connection)
+                connection, channel = None, None
+                break  # The rest stays 'Not Mined' for the next loop
+            sent += len(batch)
+            ledger.add_many(row['article_url'] for row in batch)
+
+            # Update the input rows with a new timestamp and status, and add them to the bq table
+            for row in batch:
                 row['timestamp'] = datetime.utcnow()
                 row['status'] = "Sent to queue"
-                #errors = bq_client.insert_rows(
-                errors = statusTable.insert_row(row)
-                if errors != []:
-                    print(f"We've got some errors when updating bq: {errors}", flush=True)
-            connection.close()
-            print(f"Sent {len(newData)} rows to rabbitMQ queue.", flush=True)
+            errors = statusTable.insert_rows(batch)
+            if errors != []:
+                print(f"We've got some errors when updating bq: {errors}", flush=True)
+
+        if newData:
+            print(f"Sent {sent} rows to rabbitMQ queue.", flush=True)
 
-        # Wait for the next loop
+        # Wait for the next loop, answering the broker's heartbeats meanwhile
+        if connection is not None and connection.is_open:
+            try:
+                connection.sleep(DELAY)
+                continue
+            except pika.exceptions.AMQPError:
+                close(connection)
+                connection, channel = None, None
         time.sleep(DELAY)
 except KeyboardInterrupt as e:
     print("ctrl+c caught - exiting", flush=True)
 except Exception as e:
     raise e
+finally:
+    close(connection)
+    ledger.close()
@@ -5,6 +5,9 @@ from google.cloud.exceptions import NotFound
 class BQTable:
     table_id = None
     schema = None
+    # Column the table is partitioned by (by day), and columns it's clustered by, when it's created
+    partition_field = None
+    clustering_fields = None
     def __init__(self):
         self._table = None
         self._client = None
@@ -35,12 +38,37 @@ class BQTable:
 
         try:
             self._table = self._client.get_table(_table)
+            self._CheckLayout()
         except NotFound as e:
             print(f"Creating table {table_id}.", flush=True)
-            self._table = self._client.create_table(_table)
+            self._table = self._client.create_table(self._Definition())
 
         return self
 
+    def _Definition(self):
+        '''
+        Returns the bigquery.Table to create, with its schema, partitioning and clustering.
+        '''
+        _table = bigquery.Table(self.table_id, schema = self.schema)
+        if self.partition_field is not None:
+            _table.time_partitioning = bigquery.TimePartitioning(
+                type_ = bigquery.TimePartitioningType.DAY,
+                field = self.partition_field)
+        if self.clustering_fields is not None:
+            _table.clustering_fields = self.clustering_fields
+        return _table
+
+    def _CheckLayout(self):
+        '''
+        Warns if an existing table isn't partitioned/clustered like new ones are. Existing tables aren't altered.
+        '''
+        partitioning = self._table.time_partitioning
+        if self.partition_field is not None and (partitioning is None or partitioning.field != self.partition_field):
+            print(f"Table {self.table_id} isn't partitioned by {self.partition_field}; "
+                  "recreate it to get partitioned queries.", flush=True)
+        elif self.clustering_fields is not None and self._table.clustering_fields != self.clustering_fields:
+            print(f"Table {self.table_id} isn't clustered by {', '.join(self.clustering_fields)}.", flush=True)
+
     def Query(self, query):
         '''
         Queries the table using the given query, returning a list-of-dicts representation of the data.
@@ -70,6 +98,8 @@ class BQTable:
 
 class StatusTable(BQTable):
     table_id = environ.get("STATUS_TABLE_ID")
+    partition_field = "timestamp"
+    clustering_fields = ["article_url", "status"]
     schema = [
         bigquery.SchemaField("article_url", "STRING",   mode = "REQUIRED"),
         bigquery.SchemaField("catalog_url", "STRING",   mode = "REQUIRED"),
@@ -98,6 +128,8 @@ class StatusTable(BQTable):
 
 class DataTable(BQTable):
     table_id = environ.get("DATA_TABLE_ID")
+    partition_field = "acquisition_date"
+    clustering_fields = ["source", "doi"]
     schema = [
         bigquery.SchemaField("abstract",         "STRING",   mode = "REQUIRED"),
         bigquery.SchemaField("title",            "STRING",   mode = "REQUIRED"),
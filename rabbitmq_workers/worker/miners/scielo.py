@@ -1,6 +1,7 @@
 import centaurminer as mining
 import json
 import time
+import threading
 
 class ScieloLocations(mining.PageLocations):
     """Locations on the page to be gathered by Selenium webdriver
@@ -191,10 +192,13 @@ class ScieloEngine(mining.MiningEngine):
                 self.results = None
         pass
 
-# Static miner from this file
-miner = ScieloEngine(ScieloLocations)
+# Static miner from this file, one per mining thread (each with its own browser)
+_local = threading.local()
 
 def GetArticle(url):
+    miner = getattr(_local, 'miner', None)
+    if miner is None:
+        miner = _local.miner = ScieloEngine(ScieloLocations)
     miner.gather(url)
 
     # Check for valid data
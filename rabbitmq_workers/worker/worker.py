@@ -2,6 +2,8 @@
 import pika
 import time
 import json
+import functools
+from concurrent.futures import ThreadPoolExecutor
 from os import environ
 from urllib.parse import urlparse
 import uuid
@@ -17,6 +19,13 @@ mq_user = environ.get('RABBIT_USERNAME')
 mq_pass = environ.get('RABBIT_PASSWORD')
 host_ip = environ.get('RABBIT_HOST_IP')
 #project_id = environ.get('PROJECT_ID')
+# How many messages are mined at the same time, each on its own thread (and browser)
+prefetch_count = int(environ.get('PREFETCH_COUNT', '1'))
+# Seconds between heartbeats. The connection's I/O loop keeps running on the main thread while
+# the articles are mined, so long scrapes don't make the broker drop the connection.
+heartbeat = int(environ.get('HEARTBEAT', '60'))
+# Messages whose mining crashed are queued again, up to their MAX_ATTEMPTS-th try, then marked 'Failed'
+max_attempts = int(environ.get('MAX_ATTEMPTS', '3'))
 
 assert None not in [mq_user, mq_pass, host_ip], "Include a .env file using the docker argument --env-file when running."
 
@@ -25,7 +34,7 @@ credentials = pika.PlainCredentials('guest','guest')
 
 connection = pika.BlockingConnection(
     #pika.ConnectionParameters(host='35.223.198.161', credentials=credentials))
-    pika.ConnectionParameters(host=host_ip, credentials=credentials))
+    pika.ConnectionParameters(host=host_ip, credentials=credentials, heartbeat=heartbeat))
 channel = connection.channel()
 
 channel.queue_declare(queue='task_queue', durable=True)
@@ -37,7 +46,69 @@ dataTable = DataTable().GetOrCreate()
 #bq_client = bigquery.Client()
 #table = bq_client.get_table('urls.status')
 
+def ack(ch, delivery_tag):
+    '''
+    Acks a message from a mining thread. The channel isn't thread safe, so the ack is handed to the
+    connection's I/O loop on the main thread.
+    '''
+    connection.add_callback_threadsafe(functools.partial(ch.basic_ack, delivery_tag=delivery_tag))
+
+
+def requeue(ch, delivery_tag, body, attempt):
+    '''
+    Puts a message back at the end of the queue from a mining thread, with its attempt count in the
+    x-attempt header, and acks this delivery of it (see ack).
+    '''
+    def republish():
+        ch.basic_publish(
+            exchange='',
+            routing_key='task_queue',
+            body=body,
+            properties=pika.BasicProperties(
+                delivery_mode=2,  # make message persistent
+                headers={'x-attempt': attempt + 1},
+            ))
+        ch.basic_ack(delivery_tag=delivery_tag)
+    connection.add_callback_threadsafe(republish)
+
+
+def give_up(body, attempt, error):
+    '''
+    Marks the message's url as 'Failed', with the attempt count and error in meta_info.
+    '''
+    try:
+        status = json.loads(body)
+        status['status'] = 'Failed'
+        status['timestamp'] = datetime.utcnow()
+        status['worker_id'] = self_id
+        status['meta_info'] = json.dumps({'attempt': attempt, 'error': repr(error)})
+        errors = statusTable.insert_row(status)
+    except Exception as e:
+        errors = [repr(e)]
+    if errors != []:
+        print(f"We've got some errors when updating bq: {errors}", flush=True)
+
+
 def callback(ch, method, properties, body):
+    # Runs on the connection's thread: hand the message to a mining thread and return right away
+    attempt = (properties.headers or {}).get('x-attempt', 1)
+    executor.submit(work, ch, method.delivery_tag, body, attempt)
+
+
+def work(ch, delivery_tag, body, attempt):
+    try:
+        mine(ch, delivery_tag, body)
+    except Exception as e:
+        if attempt < max_attempts:
+            print(f"Mining crashed on attempt {attempt}, requeuing the message: {e!r}", flush=True)
+            requeue(ch, delivery_tag, body, attempt)
+        else:  # It would probably crash forever: stop trying
+            print(f"Mining crashed on attempt {attempt}, giving up: {e!r}", flush=True)
+            give_up(body, attempt, e)
+            ack(ch, delivery_tag)
+
+
+def mine(ch, delivery_tag, body):
     status = json.loads(body)
     print("[x] Received %r" % body, flush=True)
 
@@ -66,7 +137,7 @@ def callback(ch, method, properties, body):
         status['status'] = 'Failed'
         status['timestamp'] = datetime.utcnow()
         errors = statusTable.insert_row(status)
-        ch.basic_ack(delivery_tag=method.delivery_tag)
+        ack(ch, delivery_tag)
         if errors != []:
             print(f"We've got some errors when updating bq: {errors}", flush=True)
         return
@@ -78,7 +149,7 @@ def callback(ch, method, properties, body):
         errors = statusTable.insert_row(status)
         if errors != []:
             print(f"We've got some errors when updating bq: {errors}", flush=True)
-        ch.basic_ack(delivery_tag=method.delivery_tag)
+        ack(ch, delivery_tag)
         return
     data['language'] = status['language']  # Should always be true...
     print("\nGot data:", flush=True)
@@ -98,10 +169,15 @@ def callback(ch, method, properties, body):
 
     print(" [x] Done\n", flush=True)
     print(' [*] Waiting for messages. To exit press CTRL+C', flush=True)
-    ch.basic_ack(delivery_tag=method.delivery_tag)
+    ack(ch, delivery_tag)
+
 
+executor = ThreadPoolExecutor(max_workers=prefetch_count, thread_name_prefix="miner")
 
-channel.basic_qos(prefetch_count=1)
+channel.basic_qos(prefetch_count=prefetch_count)
 channel.basic_consume(queue='task_queue', on_message_callback=callback)
 
-channel.start_consuming()
+try:
+    channel.start_consuming()
+finally:
+    executor.shutdown(wait=True)
@@ -1,4 +1,3 @@
-import time
 from datetime import datetime
 import centaurminer as mining
 from .tables import StatusTable
@@ -36,37 +35,43 @@ class URLBuilder:
         print("elems:", elems, flush=True)
 
         statusTable = StatusTable().GetOrCreate(project_id = self.project_id, dataset_id = self.dataset_id, table_name = self.table_id)
+        statusWriter = statusTable.batch_writer()
+        pending = []
         total_inserted = 0
-        while len(elems) != 0:
-            # Send elems to bigquery
-            for elem in elems:
-                status = {
-                    'article_url': elem,
-                    'catalog_url': url,
-                    'is_pdf': 0,
-                    'language': 'en',
-                    'status': "Not Mined",
-                    'timestamp': datetime.utcnow(),
-                    'worker_id': None,
-                    'meta_info': '{"search_terms": ["' + '","'.join(keywords) + '"]}'
-                }
-                errors = statusTable.insert_row(status)
-                print("Inserting to table:", status, flush=True)
-                if errors != []:
-                    print("Errors encountered:", errors, flush=True)
-                total_inserted += 1
+        try:
+            while len(elems) != 0:
+                # Send elems to bigquery
+                for elem in elems:
+                    status = {
+                        'article_url': elem,
+                        'catalog_url': url,
+                        'is_pdf': 0,
+                        'language': 'en',
+                        'status': "Not Mined",
+                        'timestamp': datetime.utcnow(),
+                        'worker_id': None,
+                        'meta_info': '{"search_terms": ["' + '","'.join(keywords) + '"]}'
+                    }
+                    pending.append(statusWriter.add(status))
+                    print("Inserting to table:", status, flush=True)
+                    total_inserted += 1
+                    if total_inserted == limit:
+                        break
+
+                # Break out of outer (search page) loop if limit is reached
                 if total_inserted == limit:
                     break
-                time.sleep(0.1)
-
-            # Break out of outer (search page) loop if limit is reached
-            if total_inserted == limit:
-                break
 
-            page_num += 1
-            url = base_url + f"?skip={25*page_num}&show=25"
-            self.miner.wd.get(url)
-            elems = self.miner.get(self.miner.site.link_elem, several=True)
+                page_num += 1
+                url = base_url + f"?skip={25*page_num}&show=25"
+                self.miner.wd.get(url)
+                elems = self.miner.get(self.miner.site.link_elem, several=True)
+        finally:
+            # Send whatever is left in the buffer, even if a search page failed
+            statusWriter.close()
+        errors = [error for future in pending for error in future.result()]
+        if errors != []:
+            print("Errors encountered:", errors, flush=True)
 
     @classmethod
     def connect_to_gbq(cls, credentials, project_id, url_table_id, schema=None):
@@ -1,3 +1,7 @@
+import json
+import time
+import threading
+from concurrent.futures import Future
 from os import environ
 from google.cloud import bigquery
 from google.cloud.exceptions import NotFound
@@ -5,6 +9,9 @@ from google.cloud.exceptions import NotFound
 class BQTable:
     table_id = None
     schema = None
+    # Column the table is partitioned by (by day), and columns it's clustered by, when it's created
+    partition_field = None
+    clustering_fields = None
     def __init__(self):
         self._table = None
         self._client = None
@@ -35,12 +42,37 @@ class BQTable:
 
         try:
             self._table = self._client.get_table(_table)
+            self._CheckLayout()
         except NotFound as e:
             print(f"Creating table {table_id}.", flush=True)
-            self._table = self._client.create_table(_table)
+            self._table = self._client.create_table(self._Definition())
 
         return self
 
+    def _Definition(self):
+        '''
+        Returns the bigquery.Table to create, with its schema, partitioning and clustering.
+        '''
+        _table = bigquery.Table(self.table_id, schema = self.schema)
+        if self.partition_field is not None:
+            _table.time_partitioning = bigquery.TimePartitioning(
+                type_ = bigquery.TimePartitioningType.DAY,
+                field = self.partition_field)
+        if self.clustering_fields is not None:
+            _table.clustering_fields = self.clustering_fields
+        return _table
+
+    def _CheckLayout(self):
+        '''
+        Warns if an existing table isn't partitioned/clustered like new ones are. Existing tables aren't altered.
+        '''
+        partitioning = self._table.time_partitioning
+        if self.partition_field is not None and (partitioning is None or partitioning.field != self.partition_field):
+            print(f"Table {self.table_id} isn't partitioned by {self.partition_field}; "
+                  "recreate it to get partitioned queries.", flush=True)
+        elif self.clustering_fields is not None and self._table.clustering_fields != self.clustering_fields:
+            print(f"Table {self.table_id} isn't clustered by {', '.join(self.clustering_fields)}.", flush=True)
+
     def Query(self, query):
         '''
         Queries the table using the given query, returning a list-of-dicts representation of the data.
@@ -68,8 +100,148 @@ class BQTable:
             rows = rows
         )
 
+    def batch_writer(self, **kwargs):
+        '''
+        Returns a BatchWriter that buffers rows for this table. See BatchWriter for the arguments.
+        '''
+        return BatchWriter(self, **kwargs)
+
+
+class BatchWriter:
+    '''
+    Buffers rows for a BQTable and streams them to bigquery in batches, from a background thread.
+
+    A batch is sent when `max_rows` rows or `max_bytes` bytes are buffered, or when the oldest
+    buffered row is `max_age` seconds old. Rows that bigquery rejects are retried on their own
+    (not the whole batch), up to `max_retries` times. Rows reported as invalid aren't retried.
+
+    add() returns a concurrent.futures.Future for the row, which resolves to the list of errors
+    for that row once it's been sent - an empty list means the row is stored in bigquery.
+    '''
+    def __init__(self, table, max_rows = 500, max_bytes = 5_000_000, max_age = 5, max_retries = 3):
+        self.table = table
+        self.max_rows = max_rows
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.max_retries = max_retries
+
+        self._rows = []
+        self._bytes = 0
+        self._oldest = None
+        self._closed = False
+        self._cond = threading.Condition()
+        self._thread = threading.Thread(target = self._run, name = f"BatchWriter({table.table_id})", daemon = True)
+        self._thread.start()
+
+    def add(self, row):
+        '''
+        Queues a copy of the row for insertion, and returns a Future with its errors.
+        '''
+        future = Future()
+        size = len(json.dumps(row, default = str))
+        with self._cond:
+            if self._closed:
+                raise RuntimeError("BatchWriter is closed")
+            self._rows.append((dict(row), future))
+            self._bytes += size
+            if self._oldest is None:  # Wakes the thread up to start the max_age timer
+                self._oldest = time.monotonic()
+                self._cond.notify()
+            elif self._full():
+                self._cond.notify()
+        return future
+
+    def flush(self):
+        '''
+        Sends every buffered row now, and waits until they're written (or given up on).
+        '''
+        with self._cond:
+            batch = self._take()
+        self._send(batch)
+
+    def close(self):
+        '''
+        Flushes the remaining rows and stops the background thread.
+        '''
+        with self._cond:
+            self._closed = True
+            self._cond.notify()
+        self._thread.join()
+
+    def _full(self):
+        return len(self._rows) >= self.max_rows or self._bytes >= self.max_bytes
+
+    def _take(self):
+        batch = self._rows
+        self._rows = []
+        self._bytes = 0
+        self._oldest = None
+        return batch
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._closed and not self._full():
+                    if self._oldest is None:
+                        self._cond.wait()
+                        continue
+                    timeout = self._oldest + self.max_age - time.monotonic()
+                    if timeout <= 0:
+                        break
+                    self._cond.wait(timeout)
+                batch = self._take()
+                closed = self._closed
+            self._send(batch)
+            if closed:
+                return
+
+    def _send(self, batch):
+        for attempt in range(self.max_retries + 1):
+            if not batch:
+                return
+            try:
+                errors = self.table.insert_rows([row for row, _ in batch])
+            except Exception as e:  # The whole request failed, so every row did
+                errors = [{'index': i, 'errors': [{'reason': 'request', 'message': str(e)}]} for i in range(len(batch))]
+            failed = {error['index']: error['errors'] for error in errors}
+
+            retry = []
+            for i, (row, future) in enumerate(batch):
+                if i not in failed:
+                    future.set_result([])
+                elif attempt == self.max_retries or all(e.get('reason') == 'invalid' for e in failed[i]):
+                    future.set_result(failed[i])
+                else:
+                    retry.append((row, future))
+            batch = retry
+            if batch:
+                time.sleep(min(2 ** attempt, 30))
+
+
+def on_flushed(futures, callback):
+    '''
+    Calls callback(errors) once every BatchWriter future is done, with all of their errors in one list.
+    '''
+    futures = list(futures)
+    remaining = [len(futures)]
+    lock = threading.Lock()
+
+    def done(_):
+        with lock:
+            remaining[0] -= 1
+            if remaining[0]:
+                return
+        callback([error for future in futures for error in future.result()])
+
+    if not futures:
+        callback([])
+    for future in futures:
+        future.add_done_callback(done)
+
 class StatusTable(BQTable):
     table_id = environ.get("STATUS_TABLE_ID")
+    partition_field = "timestamp"
+    clustering_fields = ["article_url", "status"]
     schema = [
         bigquery.SchemaField("article_url", "STRING",   mode = "REQUIRED"),
         bigquery.SchemaField("catalog_url", "STRING",   mode = "REQUIRED"),
@@ -98,6 +270,8 @@ class StatusTable(BQTable):
 
 class DataTable(BQTable):
     table_id = environ.get("DATA_TABLE_ID")
+    partition_field = "acquisition_date"
+    clustering_fields = ["source", "doi"]
     schema = [
         bigquery.SchemaField("abstract",         "STRING",   mode = "REQUIRED"),
         bigquery.SchemaField("title",            "STRING",   mode = "REQUIRED"),